@@ -0,0 +1,93 @@
+#
+# image_formats.py
+#
+# Compares the input formats Pokefantasia accepts (JPEG, PNG,
+# WebP, AVIF) on a synthetic 1024x1024 sprite: encoded size, and
+# decode latency through imagecodec, both at full size (OpenCV,
+# as typecov and formatcov decode) and on the reduced-size fast
+# paths (OpenCV 1/4 scale, and Pillow at >= 224 px as typeid
+# decodes, against Pillow at full size).
+#
+# Usage: python benchmarks/image_formats.py
+#
+
+import io
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda_functions", "pokefantasia_upload"))
+
+import imagecodec
+
+
+def make_sprite(size=1024, seed=0):
+  """
+  Returns a sprite-like RGB image: flat colored blobs with dark
+  anti-aliased outlines on a light background
+  """
+  rng = np.random.default_rng(seed)
+
+  image = np.full((size, size, 3), 245, np.uint8)
+
+  for i in range(12):
+    center = tuple(int(c) for c in rng.integers(size // 5, size * 4 // 5, 2))
+    axes = tuple(int(a) for a in rng.integers(size // 20, size // 5, 2))
+    color = tuple(int(c) for c in rng.integers(0, 255, 3))
+    angle = int(rng.integers(0, 180))
+
+    cv2.ellipse(image, center, axes, angle, 0, 360, color, -1, cv2.LINE_AA)
+    cv2.ellipse(image, center, axes, angle, 0, 360, (30, 30, 30), 6, cv2.LINE_AA)
+
+  return Image.fromarray(image)
+
+
+def median_ms(fn, repeat=15):
+  times = []
+  for i in range(repeat):
+    start = time.perf_counter()
+    fn()
+    times.append((time.perf_counter() - start) * 1000)
+  times.sort()
+  return times[len(times) // 2]
+
+
+def main():
+  sprite = make_sprite()
+
+  encoders = [
+    ("jpeg", "JPEG", {"quality": 90}),
+    ("png", "PNG", {"optimize": True}),
+    ("webp", "WEBP", {"quality": 90, "method": 4}),
+    ("webp-lossless", "WEBP", {"lossless": True}),
+  ]
+
+  if imagecodec.avif_supported():
+    encoders.append(("avif", "AVIF", {"quality": 70}))
+  else:
+    print("(no AVIF encoder here, skipping AVIF)")
+
+  print(f"{'format':>14} {'KB':>7} {'cv2 full ms':>12} {'cv2 1/4 ms':>11} {'pil full ms':>12} {'pil 224 ms':>11}")
+
+  for (name, pillow_format, options) in encoders:
+    buffer = io.BytesIO()
+    sprite.save(buffer, format=pillow_format, **options)
+    data = buffer.getvalue()
+
+    assert imagecodec.sniff_format(data) == name.split("-")[0]
+
+    full = median_ms(lambda: imagecodec.decode_bgr(data))
+    reduced = median_ms(lambda: imagecodec.decode_bgr(data, 4))
+    pil_full = median_ms(lambda: imagecodec.decode_pil(data).resize((224, 224)))
+    pil = median_ms(lambda: imagecodec.decode_pil(data, (224, 224)).resize((224, 224)))
+
+    print(f"{name:>14} {len(data) / 1024:>7.1f} {full:>12.1f} {reduced:>11.1f} {pil_full:>12.1f} {pil:>11.1f}")
+
+
+if __name__ == "__main__":
+  main()
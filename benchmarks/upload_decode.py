@@ -0,0 +1,101 @@
+#
+# upload_decode.py
+#
+# Compares the old and new ways pokefantasia_upload turns a
+# base64 request body into something to upload to S3, for 1, 5
+# and 20 MB images:
+#
+#   old: json.loads the body three times, b64decode the whole
+#        string to bytes, write the bytes to /tmp for upload_file
+#   new: json.loads once, bodydecoder.decode_base64 into an
+#        in-memory buffer for upload_fileobj
+#
+# Reports latency and peak memory (tracemalloc) of each path.
+# The S3 upload itself is not included, so this runs offline.
+#
+# Usage: python benchmarks/upload_decode.py
+#
+
+import base64
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda_functions", "pokefantasia_upload"))
+
+import bodydecoder
+
+
+def old_path(event):
+  body = json.loads(event["body"])
+  body = json.loads(event["body"])
+  body = json.loads(event["body"])
+
+  datastr = body["data"]
+  base64_bytes = datastr.encode()
+  bytes = base64.b64decode(base64_bytes)
+
+  local_filename = "/tmp/bench_data.jpg"
+  outfile = open(local_filename, "wb")
+  outfile.write(bytes)
+  outfile.close()
+
+  return local_filename
+
+
+def new_path(event):
+  body = bodydecoder.parse_body(event)
+
+  datastr = body["data"]
+  data = bodydecoder.decode_base64(datastr)
+
+  del body["data"]
+  del datastr
+
+  return data
+
+
+def measure(fn, event, repeat=5):
+  """
+  Returns (median latency in ms, peak memory in MB) of fn(event)
+  """
+  latencies = []
+  for i in range(repeat):
+    start = time.perf_counter()
+    fn(event)
+    latencies.append((time.perf_counter() - start) * 1000)
+
+  tracemalloc.start()
+  result = fn(event)
+  (current, peak) = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  del result
+
+  latencies.sort()
+  return (latencies[len(latencies) // 2], peak / (1024 * 1024))
+
+
+def main():
+  print(f"{'size':>6} {'path':>4} {'latency ms':>11} {'peak MB':>8}")
+
+  for mb in (1, 5, 20):
+    raw = os.urandom(mb * 1024 * 1024)
+    event = {
+      "body": json.dumps({
+        "filename": "bench.jpg",
+        "data": base64.b64encode(raw).decode()
+      })
+    }
+    del raw
+
+    for (name, fn) in (("old", old_path), ("new", new_path)):
+      (latency, peak) = measure(fn, event)
+      print(f"{mb:>4}MB {name:>4} {latency:>11.1f} {peak:>8.1f}")
+
+  os.remove("/tmp/bench_data.jpg")
+
+
+if __name__ == "__main__":
+  main()
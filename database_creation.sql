@@ -4,8 +4,17 @@ CREATE DATABASE IF NOT EXISTS pokefantasia;
 USE pokefantasia;
 
 
+DROP TABLE IF EXISTS jobtimings;
+DROP TABLE IF EXISTS jobtargets;
 DROP TABLE IF EXISTS jobs;
 DROP TABLE IF EXISTS users;
+DROP TABLE IF EXISTS circuitbreakers;
+DROP TABLE IF EXISTS ratelimits;
+DROP TABLE IF EXISTS jobcounts;
+DROP TABLE IF EXISTS jobtotals;
+DROP TABLE IF EXISTS jobhours;
+DROP TABLE IF EXISTS dedupcounts;
+DROP TABLE IF EXISTS resets;
 
 
 CREATE TABLE users
@@ -28,14 +37,201 @@ CREATE TABLE jobs
     datafilekey       varchar(256) not null,  -- PNG filename in S3 (bucketkey)
     resultsfilekey    varchar(256) not null,  -- results filename in S3 bucket
     bucket			  varchar(256) not null,  -- which S3 bucket it was placed in
+    fallback          tinyint not null default 0,  -- 1 if rendered by the local fallback
+    contenthash       char(64) not null default '',      -- sha256 of the uploaded image, '' if presigned
+    target            varchar(256) not null default '',  -- target type (typecov) or format (formatcov)
+    dedupof           int null,                          -- job whose results this job reuses
+    result            varchar(1024) null,  -- small results (typeid prediction), served without S3
+    errormsg          varchar(1024) null,  -- error message of a failed job, served without S3
+    targetcount       int not null default 1,  -- remote calls the job makes (types of a typecov job)
+    updatedat         timestamp(6) not null default current_timestamp(6)
+                        on update current_timestamp(6),  -- last change of the row (change feed)
     PRIMARY KEY (jobid),
     FOREIGN KEY (userid) REFERENCES users(userid),
-    UNIQUE      (datafilekey)
+    UNIQUE      (datafilekey),
+    --
+    -- every status change moves the row's entry in each index
+    -- on status or updatedat, so jobs only has the indexes its
+    -- queries need. Listings of one user page in jobid order
+    -- through an index that ends in jobid after its equalities
+    -- (InnoDB appends the primary key to every secondary index),
+    -- so they read a range without a filesort. Admin listings
+    -- across users by status and/or action alone walk the
+    -- primary key and stop at the page size.
+    --
+    INDEX       (bucket, status),          -- admission backlog per action
+    INDEX       (contenthash, bucket, target),  -- dedup lookup
+    INDEX       (userid, jobid),           -- listing by user; the foreign key
+    INDEX       (userid, status),          -- listing by user and status
+    INDEX       (userid, bucket, jobid),   -- listing by user and action
+    INDEX       (userid, bucket, status),  -- listing by user, action and status
+    INDEX       (updatedat, jobid)         -- change feed
 );
 
 
 ALTER TABLE jobs AUTO_INCREMENT = 1001;  -- starting value
 
+CREATE TABLE jobtargets
+(
+    jobid             int not null,
+    targettype        varchar(64) not null,   -- fire, water, ... (multi-type typecov jobs)
+    status            varchar(256) not null,  -- processing, completed, error
+    resultsfilekey    varchar(256) not null,  -- results filename in S3 bucket for this type
+    fallback          tinyint not null default 0,  -- 1 if rendered by the local fallback
+    errormsg          varchar(1024) null,     -- error message of a failed type
+    PRIMARY KEY (jobid, targettype),
+    FOREIGN KEY (jobid) REFERENCES jobs(jobid)
+);
+
+CREATE TABLE jobtimings
+(
+    jobid             int not null,
+    targettype        varchar(64) not null,   -- type of a multi-type job, '' for the whole job
+    stage             varchar(32) not null,   -- fetch, submit, queue_wait, compute, transfer, upload, db_update...
+    startedat         double not null,        -- unix time the stage started
+    durationms        int not null,
+    INDEX (startedat),
+    FOREIGN KEY (jobid) REFERENCES jobs(jobid)
+);
+
+CREATE TABLE circuitbreakers
+(
+    name              varchar(64) not null,   -- e.g. typecov-remote
+    state             varchar(16) not null,   -- closed, open, half-open
+    failures          int not null,           -- consecutive failures
+    openeduntil       double not null,        -- unix time the cooldown ends
+    PRIMARY KEY (name)
+);
+
+INSERT INTO circuitbreakers(name, state, failures, openeduntil)
+            values('typecov-remote', 'closed', 0, 0);
+
+CREATE TABLE ratelimits
+(
+    name              varchar(64) not null,   -- e.g. typecov-remote
+    tokens            double not null,        -- tokens left at updatedat
+    capacity          double not null,        -- maximum tokens (burst size)
+    refillrate        double not null,        -- tokens added per second
+    updatedat         double not null,        -- unix time of last update
+    PRIMARY KEY (name)
+);
+
+--
+-- Summary of the jobs table for the stats lambda, kept up to
+-- date by the triggers below on every insert and status change,
+-- so counts never need a scan of jobs:
+--
+CREATE TABLE jobcounts
+(
+    bucket            varchar(256) not null,  -- action, as in jobs
+    status            varchar(256) not null,
+    userid            int not null,
+    jobs              int not null,           -- jobs currently in this status
+    PRIMARY KEY (bucket, status, userid),
+    INDEX (userid)
+);
+
+CREATE TABLE jobtotals
+(
+    bucket            varchar(256) not null,  -- action, as in jobs
+    status            varchar(256) not null,
+    jobs              int not null,           -- jobs of all users currently in this status
+    PRIMARY KEY (bucket, status)
+);
+
+CREATE TABLE jobhours
+(
+    hour              datetime not null,      -- start of the hour
+    bucket            varchar(256) not null,  -- action, as in jobs
+    status            varchar(256) not null,  -- 'created', or the status jobs entered
+    jobs              int not null,           -- jobs created / entering the status that hour
+    PRIMARY KEY (hour, bucket, status)
+);
+
+CREATE TABLE dedupcounts
+(
+    bucket            varchar(256) not null,  -- action, as in jobs
+    uploads           int not null,           -- hashed uploads (i.e. not presigned)
+    hits              int not null,           -- of those, the ones that reused earlier results
+    PRIMARY KEY (bucket)
+);
+
+--
+-- One row per reset of the database (see the reset lambda).
+-- Jobids start over after a reset, so cached job rows are tied
+-- to the latest resetid (see the download lambda):
+--
+CREATE TABLE resets
+(
+    resetid           int not null AUTO_INCREMENT,
+    resetat           timestamp not null default current_timestamp,
+    PRIMARY KEY (resetid)
+);
+
+INSERT INTO resets(resetat) values(NOW());
+
+--
+-- Creating triggers with binary logging on, as it is on RDS,
+-- needs SUPER privilege unless log_bin_trust_function_creators
+-- is set. RDS doesn't grant SUPER, so set that parameter to 1
+-- in the DB parameter group of the instance before running
+-- this script.
+--
+DELIMITER //
+
+CREATE TRIGGER jobs_summary_insert AFTER INSERT ON jobs
+FOR EACH ROW
+BEGIN
+    INSERT INTO jobcounts(bucket, status, userid, jobs)
+                VALUES(NEW.bucket, NEW.status, NEW.userid, 1)
+        ON DUPLICATE KEY UPDATE jobs = jobs + 1;
+
+    INSERT INTO jobtotals(bucket, status, jobs)
+                VALUES(NEW.bucket, NEW.status, 1)
+        ON DUPLICATE KEY UPDATE jobs = jobs + 1;
+
+    INSERT INTO jobhours(hour, bucket, status, jobs)
+                VALUES(DATE_FORMAT(NOW(), '%Y-%m-%d %H:00:00'), NEW.bucket, 'created', 1),
+                      (DATE_FORMAT(NOW(), '%Y-%m-%d %H:00:00'), NEW.bucket, NEW.status, 1)
+        ON DUPLICATE KEY UPDATE jobs = jobs + 1;
+
+    IF NEW.contenthash <> '' THEN
+        INSERT INTO dedupcounts(bucket, uploads, hits)
+                    VALUES(NEW.bucket, 1, NEW.dedupof IS NOT NULL)
+            ON DUPLICATE KEY UPDATE uploads = uploads + 1, hits = hits + (NEW.dedupof IS NOT NULL);
+    END IF;
+END//
+
+CREATE TRIGGER jobs_summary_update AFTER UPDATE ON jobs
+FOR EACH ROW
+BEGIN
+    IF NEW.status <> OLD.status OR NEW.bucket <> OLD.bucket OR NEW.userid <> OLD.userid THEN
+        UPDATE jobcounts SET jobs = jobs - 1
+         WHERE bucket = OLD.bucket AND status = OLD.status AND userid = OLD.userid;
+
+        INSERT INTO jobcounts(bucket, status, userid, jobs)
+                    VALUES(NEW.bucket, NEW.status, NEW.userid, 1)
+            ON DUPLICATE KEY UPDATE jobs = jobs + 1;
+    END IF;
+
+    IF NEW.status <> OLD.status OR NEW.bucket <> OLD.bucket THEN
+        UPDATE jobtotals SET jobs = jobs - 1
+         WHERE bucket = OLD.bucket AND status = OLD.status;
+
+        INSERT INTO jobtotals(bucket, status, jobs)
+                    VALUES(NEW.bucket, NEW.status, 1)
+            ON DUPLICATE KEY UPDATE jobs = jobs + 1;
+    END IF;
+
+    IF NEW.status <> OLD.status THEN
+        INSERT INTO jobhours(hour, bucket, status, jobs)
+                    VALUES(DATE_FORMAT(NOW(), '%Y-%m-%d %H:00:00'), NEW.bucket, NEW.status, 1)
+            ON DUPLICATE KEY UPDATE jobs = jobs + 1;
+    END IF;
+END//
+
+DELIMITER ;
+
 
 --
 -- Insert some users to start with:
@@ -1,5 +1,5 @@
 #
-# Python program to open and process a JPEG file, and 
+# Python program to open and process an image file, and 
 # generate an image converting format of image to a given format
 # 
 
@@ -10,6 +10,7 @@ import uuid
 import base64
 import pathlib
 import datatier
+import imagecodec
 import urllib.parse
 import string
 import requests
@@ -211,20 +212,23 @@ def lambda_handler(event, context):
       
     extension = pathlib.Path(bucketkey).suffix
     
-    if extension != ".jpeg" and extension != ".jpg" : 
-      raise Exception("expecting S3 document to have .jpeg extension")
+    if imagecodec.format_for_extension(extension) is None:
+      raise Exception("expecting S3 document to be a JPEG, PNG, WebP or AVIF image")
     
-    bucketkey_results_file = bucketkey
+    # the result is always a JPEG:
+    bucketkey_results_file = str(pathlib.PurePosixPath(bucketkey).with_suffix(".jpg"))
     
     print("bucketkey results file:", bucketkey_results_file)
       
     #
-    # download JPEG from S3 to LOCAL file system:
+    # download image from S3 to LOCAL file system, and decode
+    # it whatever its format:
     #
     print("**DOWNLOADING '", bucketkey, "'**")
-    data = "/tmp/data.jpeg"
+    data = "/tmp/data" + extension
     bucket.download_file(bucketkey, data)
-    input_image = cv2.imread(data)
+    with open(data, "rb") as infile:
+      input_image = imagecodec.decode_bgr(infile.read())
 
 
 
@@ -352,12 +356,13 @@ def lambda_handler(event, context):
                          })
 
     #
-    # update jobs row in database:
+    # update jobs row in database, with the error message
+    # for download to serve without going to S3:
     #
 
     dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
-    sql = "UPDATE jobs SET status='error', resultsfilekey=%s WHERE datafilekey=%s;"
-    datatier.perform_action(dbConn, sql, [bucketkey_results_file, bucketkey])
+    sql = "UPDATE jobs SET status='error', resultsfilekey=%s, errormsg=%s WHERE datafilekey=%s;"
+    datatier.perform_action(dbConn, sql, [bucketkey_results_file, str(err)[:1024], bucketkey])
 
     #
     # done, return:
@@ -0,0 +1,186 @@
+#
+# circuitbreaker.py
+#
+# Circuit breaker around a remote service, with the state of
+# the breaker kept in the database so it is shared by every
+# running lambda.
+#
+# closed:    requests flow, failures are counted.
+# open:      requests are rejected until the cooldown ends.
+# half-open: one trial request is let through; its outcome
+#            closes or re-opens the breaker.
+#
+
+import time
+import datatier
+
+
+class CircuitOpenError(Exception):
+  """
+  Raised when a request is rejected because the breaker is open
+  """
+  pass
+
+
+###################################################################
+#
+# get_state:
+#
+# Returns the state of the named breaker as a tuple
+# (state, failures, openeduntil); a breaker not yet in the
+# database is closed.
+#
+def get_state(dbConn, name):
+  """
+  Returns the state of the named breaker
+
+  Parameters
+  ----------
+  dbConn : the database connection,
+  name : name of the breaker (string)
+
+  Returns
+  -------
+  (state, failures, openeduntil) tuple
+  """
+  sql = "SELECT state, failures, openeduntil FROM circuitbreakers WHERE name = %s;"
+
+  row = datatier.retrieve_one_row(dbConn, sql, [name])
+
+  if row == ():
+    sql = """
+      INSERT IGNORE INTO circuitbreakers(name, state, failures, openeduntil)
+                  VALUES(%s, 'closed', 0, 0);
+    """
+    datatier.perform_action(dbConn, sql, [name])
+    return ('closed', 0, 0.0)
+
+  return row
+
+
+###################################################################
+#
+# is_open:
+#
+# Returns True if the breaker is open and its cooldown has not
+# ended yet, i.e. a request would certainly be rejected. Unlike
+# allow_request, this never claims the half-open trial.
+#
+def is_open(dbConn, name):
+  """
+  Returns True if requests are currently being rejected
+
+  Parameters
+  ----------
+  dbConn : the database connection,
+  name : name of the breaker (string)
+
+  Returns
+  -------
+  True or False
+  """
+  (state, failures, openeduntil) = get_state(dbConn, name)
+
+  return state != 'closed' and time.time() < openeduntil
+
+
+###################################################################
+#
+# allow_request:
+#
+# Returns True if a request may be sent to the remote service.
+# When the cooldown of an open breaker has ended, exactly one
+# caller wins the move to half-open and is let through as the
+# trial request; the trial gets cooldown_secs to report back
+# before another trial is allowed.
+#
+def allow_request(dbConn, name, cooldown_secs):
+  """
+  Returns True if a request may be sent, False if the breaker
+  is open
+
+  Parameters
+  ----------
+  dbConn : the database connection,
+  name : name of the breaker (string),
+  cooldown_secs : how long the breaker stays open (float)
+
+  Returns
+  -------
+  True or False
+  """
+  (state, failures, openeduntil) = get_state(dbConn, name)
+
+  if state == 'closed':
+    return True
+
+  now = time.time()
+
+  if now < openeduntil:
+    return False
+
+  sql = """
+    UPDATE circuitbreakers SET state='half-open', openeduntil=%s
+     WHERE name=%s AND state<>'closed' AND openeduntil<=%s;
+  """
+
+  modified = datatier.perform_action(dbConn, sql, [now + cooldown_secs, name, now])
+
+  return modified == 1
+
+
+###################################################################
+#
+# record_success:
+#
+# Closes the breaker and resets the failure count.
+#
+def record_success(dbConn, name):
+  """
+  Records a successful request, closing the breaker
+
+  Parameters
+  ----------
+  dbConn : the database connection,
+  name : name of the breaker (string)
+  """
+  sql = """
+    UPDATE circuitbreakers SET state='closed', failures=0
+     WHERE name=%s AND (state<>'closed' OR failures<>0);
+  """
+
+  datatier.perform_action(dbConn, sql, [name])
+
+
+###################################################################
+#
+# record_failure:
+#
+# Counts a failed request. The breaker opens once the count
+# reaches failure_threshold, or right away if the failure was
+# the half-open trial.
+#
+def record_failure(dbConn, name, failure_threshold, cooldown_secs):
+  """
+  Records a failed request, opening the breaker if needed
+
+  Parameters
+  ----------
+  dbConn : the database connection,
+  name : name of the breaker (string),
+  failure_threshold : consecutive failures that open the breaker (int),
+  cooldown_secs : how long the breaker stays open (float)
+  """
+  sql = "UPDATE circuitbreakers SET failures=failures+1 WHERE name=%s;"
+
+  datatier.perform_action(dbConn, sql, [name])
+
+  sql = """
+    UPDATE circuitbreakers SET state='open', openeduntil=%s
+     WHERE name=%s AND (state='half-open' OR (state='closed' AND failures>=%s));
+  """
+
+  modified = datatier.perform_action(dbConn, sql, [time.time() + cooldown_secs, name, failure_threshold])
+
+  if modified == 1:
+    print("**circuit breaker", name, "is now open**")
@@ -0,0 +1,71 @@
+#
+# jobtiming.py
+#
+# Records how long each stage of a job takes, and saves the
+# timings to the jobtimings table for reporting.
+#
+
+import threading
+import time
+import datatier
+
+from contextlib import contextmanager
+
+
+###################################################################
+#
+# StageTimer:
+#
+# Collects (targettype, stage, startedat, durationms) timings
+# for one job. Safe to use from several threads at once, e.g.
+# the types of a multi-type job; targettype is "" for stages of
+# the whole job.
+#
+class StageTimer:
+  """
+  Collects stage timings of a job
+  """
+
+  def __init__(self):
+    self.timings = []
+    self.lock = threading.Lock()
+
+  def record(self, stage, started, finished, target_type=""):
+    """
+    Records a stage that ran from started to finished (unix time)
+    """
+    with self.lock:
+      self.timings.append((target_type, stage, started, int(round((finished - started) * 1000))))
+
+  @contextmanager
+  def stage(self, stage, target_type=""):
+    """
+    Times the body of a with statement as the given stage; the
+    stage is recorded even if the body raises
+    """
+    started = time.time()
+    try:
+      yield
+    finally:
+      self.record(stage, started, time.time(), target_type)
+
+  def save(self, dbConn, jobid):
+    """
+    Saves the timings recorded so far to the jobtimings table
+    with a single multi-row insert, and clears them
+    """
+    with self.lock:
+      timings = self.timings
+      self.timings = []
+
+    if len(timings) == 0:
+      return
+
+    sql = "INSERT INTO jobtimings(jobid, targettype, stage, startedat, durationms) VALUES "
+    sql += ", ".join(["(%s, %s, %s, %s, %s)"] * len(timings)) + ";"
+
+    parameters = []
+    for (target_type, stage, started, durationms) in timings:
+      parameters.extend([jobid, target_type, stage, started, durationms])
+
+    datatier.perform_action(dbConn, sql, parameters)
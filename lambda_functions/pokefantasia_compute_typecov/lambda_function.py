@@ -1,5 +1,5 @@
 #
-# Python program to open and process a JPEG file, and 
+# Python program to open and process an image file, and 
 # generate an image converting a pokemon image to a given type
 # 
 
@@ -7,15 +7,489 @@ import json
 import boto3
 import os
 import uuid
+import io
 import base64
 import pathlib
 import datatier
+import imagecodec
 import urllib.parse
 import string
 import requests
+import random
+import threading
+import time
+import circuitbreaker
+import ratelimit
+import jobtiming
+import typerecolor
+import pokemontypes
+import cv2
+import numpy as np
+import mimetypes
+
+from boto3.s3.transfer import TransferConfig
 
 from configparser import ConfigParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from gradio_client import Client, handle_file
+from gradio_client.utils import Status
+
+
+#
+# output formats: extension, content type and OpenCV
+# encoding parameter for quality
+#
+output_formats = {
+  "jpeg": (".jpg", "image/jpeg", cv2.IMWRITE_JPEG_QUALITY),
+  "png": (".png", "image/png", None),
+  "webp": (".webp", "image/webp", cv2.IMWRITE_WEBP_QUALITY)
+}
+
+
+class RemoteSettings:
+  """
+  How the remote model is called, from the [typecov] section of
+  the config file: the circuit breaker shared by all typecov
+  lambdas, the timeout and retries of each call, how long to
+  wait for the rate limiter, and whether to render locally
+  while the remote model is unavailable.
+  """
+
+  def __init__(self, configur):
+    self.breaker = 'typecov-remote'
+    self.timeout_secs = configur.getfloat('typecov', 'remote_timeout_secs', fallback=120)
+    self.max_retries = configur.getint('typecov', 'max_retries', fallback=3)
+    self.failure_threshold = configur.getint('typecov', 'failure_threshold', fallback=5)
+    self.cooldown_secs = configur.getfloat('typecov', 'cooldown_secs', fallback=60)
+    self.backoff_base_secs = configur.getfloat('typecov', 'backoff_base_secs', fallback=1)
+    self.backoff_max_secs = configur.getfloat('typecov', 'backoff_max_secs', fallback=20)
+    self.rate_limit_wait_secs = configur.getfloat('typecov', 'rate_limit_wait_secs', fallback=30)
+    self.fallback = configur.getboolean('typecov', 'fallback', fallback=True)
+
+
+class OutputSettings:
+  """
+  How results are stored, from the [typecov] section of the
+  config file: the output format and quality, and the limits of
+  streaming results from the remote model to S3.
+  """
+
+  def __init__(self, configur):
+    self.format = configur.get('typecov', 'output_format', fallback='jpeg')
+    self.quality = configur.getint('typecov', 'output_quality', fallback=90)
+    self.max_transcode_bytes = configur.getint('typecov', 'max_transcode_bytes', fallback=32 * 1024 * 1024)
+
+    if self.format not in output_formats:
+      raise Exception("unsupported output_format in config: " + self.format)
+
+    multipart_chunksize = configur.getint('typecov', 'multipart_chunksize', fallback=8 * 1024 * 1024)
+
+    self.transfer_config = TransferConfig(multipart_threshold=multipart_chunksize,
+                                          multipart_chunksize=multipart_chunksize,
+                                          max_concurrency=2)
+
+
+class RemoteJob:
+  """
+  What the types of one job share while calling the remote
+  model: the settings, the database connection and its lock
+  (for the circuit breaker), the rate limiter, the retry budget
+  (a semaphore), the deadline (unix time), the stage timer, and
+  the headers of the remote server once connected.
+  """
+
+  def __init__(self, settings, output, dbConn, db_lock, rate_limiter, deadline, timer):
+    self.settings = settings
+    self.output = output
+    self.dbConn = dbConn
+    self.db_lock = db_lock
+    self.rate_limiter = rate_limiter
+    self.retry_budget = threading.Semaphore(settings.max_retries)
+    self.deadline = deadline
+    self.timer = timer
+    self.headers = None
+
+
+def results_key_for_type(bucketkey, target_type, output_format):
+  """
+  Returns the bucket key of the per-type results file of a
+  multi-type job, e.g. user/pikachu-<uuid>-fire.jpg
+  """
+  return str(pathlib.PurePosixPath(bucketkey).with_suffix("")) + "-" + target_type + output_formats[output_format][0]
+
+
+def encode_image(image, output_format, quality):
+  """
+  Encodes an image (numpy array, BGR) in the output format.
+
+  Returns:
+  - encoded: the encoded image as bytes.
+  """
+  (extension, content_type, quality_param) = output_formats[output_format]
+
+  params = [quality_param, quality] if quality_param is not None else []
+
+  ok, encoded = cv2.imencode(extension, image, params)
+
+  if not ok:
+    raise Exception("unable to encode image as " + output_format)
+
+  return encoded.tobytes()
+
+
+def open_remote_result(result, timeout_secs, headers):
+  """
+  Opens the result returned by the remote model for streaming.
+  The client doesn't download result files, so the result is
+  normally the URL of the image on the remote server; a local
+  path is also accepted.
+
+  Returns:
+  - (stream, content_type): a file-like object to read the
+    image from, and its content type if known.
+  """
+  if isinstance(result, dict):
+    result = result.get('url') or result.get('path')
+
+  if result.startswith("http://") or result.startswith("https://"):
+    response = requests.get(result, stream=True, timeout=timeout_secs, headers=headers)
+    response.raise_for_status()
+
+    # undo any transfer compression while streaming:
+    response.raw.decode_content = True
+
+    content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+    return (response.raw, content_type)
+
+  return (open(result, "rb"), mimetypes.guess_type(result)[0])
+
+
+def upload_remote_result(result, output_bucket, target_type, bucketkey_results_file, remote):
+  """
+  Streams the result of the remote model into the output bucket
+  without staging it on disk. If the result is already in the
+  output format, the bytes pass straight through a multipart
+  upload, and memory use is bounded by the part size. Otherwise
+  the image is transcoded in memory on the way, which is bounded
+  by max_transcode_bytes since results are 1024x1024.
+
+  Parameters:
+  - result: result of the remote model (URL or path).
+  - output_bucket: S3 bucket for the results.
+  - target_type: type of the result.
+  - bucketkey_results_file: bucket key for the result.
+  - remote: RemoteJob of the job.
+  """
+  (extension, content_type, quality_param) = output_formats[remote.output.format]
+
+  timer = remote.timer
+
+  #
+  # transfer: connecting to the remote server, plus reading
+  # the whole result when transcoding; when passing through,
+  # the bytes are read while uploading
+  #
+  with timer.stage("transfer", target_type):
+    (stream, remote_content_type) = open_remote_result(result, remote.settings.timeout_secs, remote.headers)
+
+  try:
+    if remote_content_type != content_type:
+      print(f"**transcoding result from {remote_content_type} to {content_type}**")
+
+      with timer.stage("transfer", target_type):
+        data = stream.read(remote.output.max_transcode_bytes + 1)
+
+      if len(data) > remote.output.max_transcode_bytes:
+        raise Exception("result of remote model is too large to transcode")
+
+      with timer.stage("transcode", target_type):
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        del data
+
+        if image is None:
+          raise Exception("unable to decode result of remote model")
+
+        stream.close()
+        stream = io.BytesIO(encode_image(image, remote.output.format, remote.output.quality))
+
+    with timer.stage("upload", target_type):
+      output_bucket.upload_fileobj(stream,
+                         bucketkey_results_file,
+                         ExtraArgs={
+                           'ACL': 'public-read',
+                           'ContentType': content_type
+                         },
+                         Config=remote.output.transfer_config)
+  finally:
+    stream.close()
+
+
+def call_remote_model(client, local_file, target_type, timeout_secs, timer):
+  """
+  Sends one conversion request to the remote model and waits at
+  most timeout_secs for the result. The job status is polled so
+  the time spent waiting in the remote queue can be told apart
+  from the time spent generating the image.
+
+  Parameters:
+  - client: gradio client for the remote model.
+  - local_file: path to the input image.
+  - target_type: type to convert to.
+  - timeout_secs: how long to wait for the result.
+  - timer: jobtiming.StageTimer for the job.
+
+  Returns:
+  - result: URL of the resulting image.
+  """
+  with timer.stage("submit", target_type):
+    job = client.submit(
+        image=handle_file(local_file),
+        prompt=pokemontypes.type_to_prompt[target_type],
+        scale=0.7,
+        seed=42,
+        randomize_seed=True,
+        width=1024,
+        height=1024,
+        api_name="/process_image"
+    )
+
+  submitted = time.time()
+  started = None
+
+  while not job.done():
+    if started is None and job.status().code in (Status.PROCESSING, Status.ITERATING, Status.PROGRESS):
+      started = time.time()
+
+    if time.time() - submitted > timeout_secs:
+      job.cancel()
+      raise TimeoutError(f"remote model did not respond within {timeout_secs:.0f} seconds")
+
+    time.sleep(0.25)
+
+  finished = time.time()
+
+  #
+  # if the job was never seen processing, it finished between
+  # two polls; count all of it as compute:
+  #
+  if started is None:
+    started = submitted
+
+  timer.record("queue_wait", submitted, started, target_type)
+  timer.record("compute", started, finished, target_type)
+
+  result = job.result()
+
+  # Index into tuple, first element is the image
+  return result[0]
+
+
+def call_with_retries(client, local_file, target_type, remote):
+  """
+  Calls the remote model through the shared circuit breaker,
+  retrying failed calls with jittered exponential backoff while
+  the retry budget and the time left allow it.
+
+  Parameters:
+  - client: gradio client for the remote model.
+  - local_file: path to the input image.
+  - target_type: type to convert to.
+  - remote: RemoteJob of the job.
+
+  Returns:
+  - result: URL of the resulting image.
+  """
+  attempt = 0
+
+  while True:
+    with remote.db_lock:
+      allowed = circuitbreaker.allow_request(remote.dbConn, remote.settings.breaker, remote.settings.cooldown_secs)
+
+    if not allowed:
+      raise circuitbreaker.CircuitOpenError("remote model is unavailable (circuit breaker is open)")
+
+    #
+    # every request to the remote model, retries included,
+    # takes a token from the rate limiter shared by all
+    # typecov lambdas:
+    #
+    wait_secs = min(remote.settings.rate_limit_wait_secs, remote.deadline - time.time())
+
+    if not remote.rate_limiter.acquire(max(0, wait_secs)):
+      raise ratelimit.RateLimitedError("remote model rate limit reached")
+
+    timeout_secs = min(remote.settings.timeout_secs, remote.deadline - time.time())
+
+    if timeout_secs <= 0:
+      raise TimeoutError("no time left to call the remote model")
+
+    try:
+      result = call_remote_model(client, local_file, target_type, timeout_secs, remote.timer)
+    except Exception as err:
+      with remote.db_lock:
+        circuitbreaker.record_failure(remote.dbConn, remote.settings.breaker,
+                                      remote.settings.failure_threshold, remote.settings.cooldown_secs)
+
+      attempt += 1
+      delay = random.uniform(0, min(remote.settings.backoff_max_secs, remote.settings.backoff_base_secs * 2 ** attempt))
+
+      if time.time() + delay >= remote.deadline:
+        raise
+      if not remote.retry_budget.acquire(blocking=False):
+        print("**retry budget exhausted**")
+        raise
+
+      print(f"**remote call for '{target_type}' failed ({err}), retry {attempt} in {delay:.1f} seconds**")
+      time.sleep(delay)
+      continue
+
+    with remote.db_lock:
+      circuitbreaker.record_success(remote.dbConn, remote.settings.breaker)
+
+    return result
+
+
+def render_type_locally(output_bucket, local_file, target_type, bucketkey_results_file, remote):
+  """
+  Fallback for when the remote model is unavailable: renders the
+  type with the local type recolor renderer, and uploads the
+  resulting image to the output bucket, flagged as a fallback.
+
+  Parameters:
+  - output_bucket: S3 bucket for the results.
+  - local_file: path to the input image.
+  - target_type: type to convert to.
+  - bucketkey_results_file: bucket key for the result.
+  - remote: RemoteJob of the job.
+  """
+  with remote.timer.stage("fallback", target_type):
+    with open(local_file, "rb") as infile:
+      input_image = imagecodec.decode_bgr(infile.read())
+
+    output_image = typerecolor.render_type_recolor(input_image, target_type)
+
+    encoded = encode_image(output_image, remote.output.format, remote.output.quality)
+
+  with remote.timer.stage("upload", target_type):
+    output_bucket.put_object(Key=bucketkey_results_file,
+                             Body=encoded,
+                             ACL='public-read',
+                             ContentType=output_formats[remote.output.format][1],
+                             Metadata={
+                               'fallback': 'true'
+                             })
+
+
+def render_type(client, output_bucket, local_file, target_type, bucketkey_results_file, remote):
+  """
+  Converts the pokemon image to the given type using the remote
+  model, and uploads the resulting image to the output bucket.
+  When the remote model is unavailable (no client, or the
+  circuit breaker is open) or still fails once retries run out,
+  and fallback is enabled, the type is rendered locally instead.
+  Being rate limited isn't a failure of the remote model: the
+  RateLimitedError is raised so the job can be requeued.
+
+  Parameters:
+  - client: gradio client for the remote model, or None if the
+    remote model is unavailable.
+  - output_bucket: S3 bucket for the results.
+  - local_file: path to the input image.
+  - target_type: type to convert to.
+  - bucketkey_results_file: bucket key for the result.
+  - remote: RemoteJob of the job.
+
+  Returns:
+  - fallback: True if the type was rendered locally.
+  """
+  result = None
+
+  if client is not None:
+    try:
+      result = call_with_retries(client, local_file, target_type, remote)
+    except ratelimit.RateLimitedError:
+      raise
+    except Exception as err:
+      if not remote.settings.fallback:
+        raise
+
+      print(f"**remote model failed for '{target_type}': {err}**")
+
+  if result is None:
+    if not remote.settings.fallback:
+      raise circuitbreaker.CircuitOpenError("remote model is unavailable (circuit breaker is open)")
+
+    print(f"**remote model unavailable, rendering '{target_type}' locally**")
+
+    render_type_locally(output_bucket, local_file, target_type, bucketkey_results_file, remote)
+    return True
+
+  print(f"Processing of '{target_type}' completed:", result)
+
+  upload_remote_result(result, output_bucket, target_type, bucketkey_results_file, remote)
+
+  return False
+
+
+def record_target_error(output_bucket, dbConn, db_lock, jobid, target_type, bucketkey_results_file, msg):
+  """
+  Records the failure of one type of a multi-type job: the
+  results file of the type holds the error message, same as for
+  a failed job, and its jobtargets row is set to error with the
+  message.
+  """
+  print(f"**ERROR processing type '{target_type}'**")
+  print(msg)
+
+  output_bucket.put_object(Key=bucketkey_results_file,
+                           Body=(msg + "\n").encode(),
+                           ACL='public-read',
+                           ContentType='text/plain')
+
+  sql = "UPDATE jobtargets SET status='error', errormsg=%s WHERE jobid=%s AND targettype=%s;"
+  with db_lock:
+    datatier.perform_action(dbConn, sql, [msg[:1024], jobid, target_type])
+
+
+def save_timings(timer, dbConn, jobid):
+  """
+  Saves the stage timings of the job; timings are only for
+  reporting, so failing to save them doesn't fail the job.
+  """
+  try:
+    timer.save(dbConn, jobid)
+  except Exception as err:
+    print("**unable to save job timings:", str(err), "**")
+
+
+def requeue(event, context, max_requeues):
+  """
+  Runs the job again later, by invoking this lambda again
+  asynchronously with the same event. The number of times a job
+  has been requeued is counted in the event.
+
+  Returns:
+  - True if the job was requeued, False if it can't be.
+  """
+  requeues = event.get('requeues', 0)
+
+  if context is None or requeues >= max_requeues:
+    return False
+
+  payload = dict(event)
+  payload['requeues'] = requeues + 1
+
+  print(f"**requeueing job ({requeues + 1} of {max_requeues})**")
+
+  #
+  # invoke with the lambda's own role, not the S3 profile:
+  #
+  lambda_client = boto3.session.Session().client('lambda')
+  lambda_client.invoke(FunctionName=context.invoked_function_arn,
+                       InvocationType='Event',
+                       Payload=json.dumps(payload))
+  return True
+
 
 def lambda_handler(event, context):
   try:
@@ -59,6 +533,42 @@ def lambda_handler(event, context):
     rds_pwd = configur.get('rds', 'user_pwd')
     rds_dbname = configur.get('rds', 'db_name')
     
+    #
+    # how many types of a multi-type job are sent to the
+    # remote model at the same time:
+    #
+    max_concurrency = configur.getint('typecov', 'max_concurrency', fallback=4)
+
+    #
+    # calls to the remote model go through a circuit breaker
+    # shared by all typecov lambdas, and failed calls are
+    # retried under a retry budget and the time left, or
+    # rendered locally if they still fail (see RemoteSettings):
+    #
+    settings = RemoteSettings(configur)
+    reserve_secs = configur.getfloat('typecov', 'reserve_secs', fallback=15)
+
+    #
+    # requests to the remote model are rate limited; when no
+    # token comes in time the job is requeued:
+    #
+    rate_limit_backend = configur.get('typecov', 'rate_limit_backend', fallback='mysql')
+    rate_limit_capacity = configur.getfloat('typecov', 'rate_limit_capacity', fallback=5)
+    rate_limit_per_sec = configur.getfloat('typecov', 'rate_limit_per_sec', fallback=0.5)
+    max_requeues = configur.getint('typecov', 'max_requeues', fallback=3)
+
+    #
+    # results are streamed from the remote model to S3, and
+    # transcoded to the output format on the way if needed
+    # (see OutputSettings):
+    #
+    output = OutputSettings(configur)
+
+    if context is not None:
+      deadline = time.time() + context.get_remaining_time_in_millis() / 1000 - reserve_secs
+    else:
+      deadline = time.time() + settings.timeout_secs * (settings.max_retries + 1)
+
     #
     # this function is event-driven by a JPEG being
     # dropped into S3. The bucket key is sent to 
@@ -70,24 +580,44 @@ def lambda_handler(event, context):
       
     extension = pathlib.Path(bucketkey).suffix
     
-    if extension != ".jpeg" and extension != ".jpg" : 
-      raise Exception("expecting S3 document to have .jpeg extension")
+    if imagecodec.format_for_extension(extension) is None:
+      raise Exception("expecting S3 document to be a JPEG, PNG, WebP or AVIF image")
     
-    bucketkey_results_file = bucketkey
+    bucketkey_results_file = str(pathlib.PurePosixPath(bucketkey).with_suffix(output_formats[output.format][0]))
     
     print("bucketkey results file:", bucketkey_results_file)
       
     #
-    # download JPEG from S3 to LOCAL file system:
+    # time each stage of the job, for the timing report:
+    #
+    timer = jobtiming.StageTimer()
+
+    #
+    # download image from S3 to LOCAL file system:
     #
     print("**DOWNLOADING '", bucketkey, "'**")
-    local_file = "/tmp/data.jpeg"
-    bucket.download_file(bucketkey, local_file)
+    local_file = "/tmp/data" + extension
+
+    with timer.stage("fetch"):
+      bucket.download_file(bucketkey, local_file)
+
+      #
+      # the remote model takes JPEG, PNG and WebP; an AVIF
+      # input is handed to it (and the fallback) as PNG:
+      #
+      with open(local_file, "rb") as infile:
+        data = infile.read()
+
+      if imagecodec.sniff_format(data) == "avif":
+        print("**converting AVIF input to PNG**")
+        local_file = "/tmp/data.png"
+        cv2.imwrite(local_file, imagecodec.decode_bgr(data))
 
+      del data
 
-    # Get object metadata
-    s3_client = boto3.client('s3')  # Create an S3 client
-    response = s3_client.head_object(Bucket=bucketname, Key=bucketkey)
+      # Get object metadata
+      s3_client = boto3.client('s3')  # Create an S3 client
+      response = s3_client.head_object(Bucket=bucketname, Key=bucketkey)
     
     # Access custom metadata
     metadata = response.get('Metadata', {})
@@ -99,6 +629,23 @@ def lambda_handler(event, context):
     else:
         raise ValueError("Target type not found in S3 metadata.")
 
+    #
+    # a job can ask for one type, or for several types of
+    # the same image (multi-type job):
+    #
+    target_types = pokemontypes.parse_target_types(target_type)
+
+    if len(target_types) == 0:
+      raise ValueError("Target type not found in S3 metadata.")
+
+    # Check if the types are valid
+    for t in target_types:
+      if t not in pokemontypes.type_to_prompt:
+        raise Exception(f"Error: '{t}' is not a valid Pokémon type.")
+
+    multi = len(target_types) > 1
+
+    print("target types:", target_types)
     
     # open connection to the database
     # change status column to "processing"
@@ -106,86 +653,183 @@ def lambda_handler(event, context):
     print("**Opening DB connection**")
     
     dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
-    sql = "UPDATE jobs SET status='processing' WHERE datafilekey=%s;"
+    #
+    # updatedat is set even if the job is already processing
+    # (a requeued job), since upload's admission takes jobs
+    # that haven't changed in a while for stale:
+    #
+    sql = "UPDATE jobs SET status='processing', updatedat=NOW(6) WHERE datafilekey=%s;"
     datatier.perform_action(dbConn, sql, [bucketkey])
     
+    sql = "SELECT jobid FROM jobs WHERE datafilekey=%s;"
+    row = datatier.retrieve_one_row(dbConn, sql, [bucketkey])
+
+    if row == ():
+      raise Exception("no job found for datafilekey " + bucketkey)
+
+    jobid = row[0]
+
     # 
-    # Call API to convert image to different type
-    client = Client("InstantX/SD35-IP-Adapter")
-
-    type_to_prompt = {
-      "normal": "Change the Pokémon into a Normal type.",
-      "fire": "Change the Pokémon into a Fire type.",
-      "water": "Change the Pokémon into a Water type.",
-      "electric": "Change the Pokémon into an Electric type.",
-      "grass": "Change the Pokémon into a Grass type.",
-      "ice": "Change the Pokémon into an Ice type.",
-      "fighting": "Change the Pokémon into a Fighting type.",
-      "poison": "Change the Pokémon into a Poison type.",
-      "ground": "Change the Pokémon into a Ground type.",
-      "flying": "Change the Pokémon into a Flying type.",
-      "psychic": "Change the Pokémon into a Psychic type.",
-      "bug": "Change the Pokémon into a Bug type.",
-      "rock": "Change the Pokémon into a Rock type.",
-      "ghost": "Change the Pokémon into a Ghost type.",
-      "dragon": "Change the Pokémon into a Dragon type.",
-      "dark": "Change the Pokémon into a Dark type.",
-      "steel": "Change the Pokémon into a Steel type.",
-      "fairy": "Change the Pokémon into a Fairy type."
-    }
+    # for a multi-type job, each type gets its own results
+    # file and its own row in jobtargets so progress can be
+    # reported per type:
+    #
+    results_keys = {}
+
+    if multi:
+      sql = """
+        INSERT INTO jobtargets(jobid, targettype, status, resultsfilekey)
+                    VALUES(%s, %s, 'processing', %s)
+        ON DUPLICATE KEY UPDATE status=IF(status='completed', status, 'processing');
+      """
 
-    # Check if the type is valid
-    if target_type in type_to_prompt:
-        # Make the API call
-        result = client.predict(
-            image=handle_file(local_file),
-            prompt=type_to_prompt[target_type],
-            scale=0.7,
-            seed=42,
-            randomize_seed=True,
-            width=1024,
-            height=1024,
-            api_name="/process_image"
-        )
-        print("Processing completed. File saved.")
+      for t in target_types:
+        results_keys[t] = results_key_for_type(bucketkey, t, output.format)
+        datatier.perform_action(dbConn, sql, [jobid, t, results_keys[t]])
     else:
-        print(f"Error: '{target_type}' is not a valid Pokémon type.")
+      results_keys[target_types[0]] = bucketkey_results_file
 
-    # Index into dictionary
-    result = result[0]
-    
-    print(result)
-    
-    # Write result into output file
-    local_results_file = "/tmp/results.jpg"
+    completed = []
+    failed = {}
+    fallbacks = []
+    ratelimited = []
+
+    #
+    # a requeued multi-type job only redoes the types that
+    # haven't completed yet:
+    #
+    if multi:
+      sql = "SELECT targettype, fallback FROM jobtargets WHERE jobid=%s AND status='completed';"
+      rows = datatier.retrieve_all_rows(dbConn, sql, [jobid])
+
+      for (t, fallback) in rows:
+        completed.append(t)
+        if fallback == 1:
+          fallbacks.append(t)
+
+      if len(completed) > 0:
+        print("already completed types:", completed)
+
+    todo_types = [t for t in target_types if t not in completed]
+
+    #
+    # Call API to convert image to the different types, at
+    # most max_concurrency at a time:
+    #
+    db_lock = threading.Lock()
+
+    if rate_limit_backend == "local":
+      rate_limiter = ratelimit.LocalTokenBucket(rate_limit_capacity, rate_limit_per_sec)
+    else:
+      rate_limiter = ratelimit.TokenBucket(dbConn, 'typecov-remote', rate_limit_capacity,
+                                           rate_limit_per_sec, lock=db_lock)
+
+    remote = RemoteJob(settings, output, dbConn, db_lock, rate_limiter, deadline, timer)
 
-    print("local results file:", local_results_file)
-    
-    with open(local_results_file, 'w') as outfile:
-      outfile.write(result)
-    
-    print("Results written to local results file")
-    
     #
-    # upload the results file to S3:
+    # don't even connect if the remote model is known to be
+    # down; without a client every type is rendered locally,
+    # or the job fails fast if fallback is disabled:
     #
-    print("**UPLOADING to S3 file", bucketkey_results_file, "**")
+    client = None
+
+    if circuitbreaker.is_open(dbConn, settings.breaker):
+      print("**remote model circuit breaker is open**")
+    else:
+      try:
+        #
+        # don't let the client download result files to /tmp,
+        # they are streamed from the remote server instead:
+        #
+        client = Client("InstantX/SD35-IP-Adapter", download_files=False)
+        remote.headers = client.headers
+      except Exception as err:
+        print("**unable to connect to remote model:", str(err), "**")
+        circuitbreaker.record_failure(dbConn, settings.breaker, settings.failure_threshold, settings.cooldown_secs)
+        if not settings.fallback:
+          raise
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(todo_types)))) as executor:
+      futures = {
+        executor.submit(render_type, client, output_bucket, local_file, t, results_keys[t], remote): t
+        for t in todo_types
+      }
+
+      for future in as_completed(futures):
+        t = futures[future]
+    
+        try:
+          fallback = future.result()
+        except ratelimit.RateLimitedError as err:
+          if not multi:
+            raise
+
+          #
+          # decided after all types are done: requeue, or
+          # fail the type if the job can't be requeued
+          #
+          print(f"**type '{t}' was rate limited**")
+          ratelimited.append(t)
+          failed[t] = str(err)
+          continue
+        except Exception as err:
+          if not multi:
+            raise
+
+          failed[t] = str(err)
+
+          record_target_error(output_bucket, dbConn, db_lock, jobid, t, results_keys[t], str(err))
+          continue
+    
+        completed.append(t)
+
+        if fallback:
+          fallbacks.append(t)
+
+        if multi:
+          sql = "UPDATE jobtargets SET status='completed', fallback=%s WHERE jobid=%s AND targettype=%s;"
+          with db_lock:
+            datatier.perform_action(dbConn, sql, [fallback, jobid, t])
+
+        print(f"**Type '{t}' done, {len(completed) + len(failed)} of {len(target_types)}**")
+
+    if len(ratelimited) > 0:
+      if requeue(event, context, max_requeues):
+        #
+        # the job waits in the queue, still processing; keep
+        # it from looking stale to upload's admission:
+        #
+        sql = "UPDATE jobs SET updatedat=NOW(6) WHERE jobid=%s;"
+        with db_lock:
+          datatier.perform_action(dbConn, sql, [jobid])
+
+        save_timings(timer, dbConn, jobid)
+        return {
+          'statusCode': 202,
+          'body': json.dumps("requeued")
+        }
 
-    output_bucket.upload_file(result,
-                       bucketkey_results_file,
-                       ExtraArgs={
-                         'ACL': 'public-read',
-                         'ContentType': 'image/jpeg'
-                       })
+      for t in ratelimited:
+        record_target_error(output_bucket, dbConn, db_lock, jobid, t, results_keys[t], failed[t])
+
+    if len(completed) == 0:
+      raise Exception("all target types failed: " + "; ".join(f"{t}: {msg}" for t, msg in failed.items()))
     
     # 
     # The last step is to update the database to change
     # the status of this job, and store the results
-    # bucketkey for download:
+    # bucketkey for download. The job is flagged as a fallback
+    # result if any of its types was rendered locally:
     #
     
-    sql = "UPDATE jobs SET status='completed', resultsfilekey=%s WHERE datafilekey=%s;"
-    datatier.perform_action(dbConn, sql, [bucketkey_results_file, bucketkey])
+    if len(fallbacks) > 0:
+      print("fallback types:", fallbacks)
+
+    with timer.stage("db_update"):
+      sql = "UPDATE jobs SET status='completed', resultsfilekey=%s, fallback=%s WHERE datafilekey=%s;"
+      datatier.perform_action(dbConn, sql, [bucketkey_results_file, len(fallbacks) > 0, bucketkey])
+
+    save_timings(timer, dbConn, jobid)
 
     #
     # done!
@@ -204,6 +848,15 @@ def lambda_handler(event, context):
   # on an error, try to upload error message to S3:
   #
   except Exception as err:
+    #
+    # a job that was only rate limited is run again later:
+    #
+    if isinstance(err, ratelimit.RateLimitedError) and requeue(event, context, max_requeues):
+      return {
+        'statusCode': 202,
+        'body': json.dumps("requeued")
+      }
+
     print("**ERROR**")
     print(str(err))
     
@@ -233,12 +886,13 @@ def lambda_handler(event, context):
                          })
 
     #
-    # update jobs row in database:
+    # update jobs row in database, with the error message
+    # for download to serve without going to S3:
     #
 
     dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
-    sql = "UPDATE jobs SET status='error', resultsfilekey=%s WHERE datafilekey=%s;"
-    datatier.perform_action(dbConn, sql, [bucketkey_results_file, bucketkey])
+    sql = "UPDATE jobs SET status='error', resultsfilekey=%s, errormsg=%s WHERE datafilekey=%s;"
+    datatier.perform_action(dbConn, sql, [bucketkey_results_file, str(err)[:1024], bucketkey])
 
     #
     # done, return:
@@ -0,0 +1,53 @@
+#
+# pokemontypes.py
+#
+# The pokemon types typecov converts to, with the prompt for
+# each, and parsing of the target types a job asks for. The
+# same module is used by upload and by typecov, so the number
+# of remote calls upload admits a job for is the number of
+# types typecov converts it to.
+#
+
+
+type_to_prompt = {
+  "normal": "Change the Pokémon into a Normal type.",
+  "fire": "Change the Pokémon into a Fire type.",
+  "water": "Change the Pokémon into a Water type.",
+  "electric": "Change the Pokémon into an Electric type.",
+  "grass": "Change the Pokémon into a Grass type.",
+  "ice": "Change the Pokémon into an Ice type.",
+  "fighting": "Change the Pokémon into a Fighting type.",
+  "poison": "Change the Pokémon into a Poison type.",
+  "ground": "Change the Pokémon into a Ground type.",
+  "flying": "Change the Pokémon into a Flying type.",
+  "psychic": "Change the Pokémon into a Psychic type.",
+  "bug": "Change the Pokémon into a Bug type.",
+  "rock": "Change the Pokémon into a Rock type.",
+  "ghost": "Change the Pokémon into a Ghost type.",
+  "dragon": "Change the Pokémon into a Dragon type.",
+  "dark": "Change the Pokémon into a Dark type.",
+  "steel": "Change the Pokémon into a Steel type.",
+  "fairy": "Change the Pokémon into a Fairy type."
+}
+
+
+def parse_target_types(target_type):
+  """
+  Parses the target-type metadata value into a list of types.
+
+  Parameters:
+  - target_type: a single type ("fire"), a comma-separated list
+    of types ("fire,water"), or "all" for every type.
+
+  Returns:
+  - target_types: list of type names, without duplicates.
+  """
+  if target_type.strip().lower() == "all":
+    return list(type_to_prompt)
+
+  target_types = []
+  for t in target_type.split(","):
+    t = t.strip().lower()
+    if t != "" and t not in target_types:
+      target_types.append(t)
+  return target_types
@@ -0,0 +1,184 @@
+#
+# ratelimit.py
+#
+# Token bucket rate limiter for calls to a remote service.
+# TokenBucket keeps the bucket in the database so the rate is
+# shared by every running lambda; LocalTokenBucket is an
+# in-process stand-in with the same interface, for testing
+# without a database.
+#
+
+import random
+import threading
+import time
+import datatier
+
+
+class RateLimitedError(Exception):
+  """
+  Raised when no token could be acquired in time
+  """
+  pass
+
+
+###################################################################
+#
+# TokenBucket:
+#
+# A token bucket stored in the ratelimits table. Tokens refill
+# continuously at refill_rate per second up to capacity; taking
+# a token is a single conditional UPDATE, so concurrent lambdas
+# can never take more tokens than there are. Time is taken from
+# the database server so lambdas don't need synchronized clocks.
+#
+class TokenBucket:
+  """
+  Token bucket shared through the database
+
+  Parameters
+  ----------
+  dbConn : the database connection,
+  name : name of the bucket (string),
+  capacity : maximum number of tokens, i.e. the burst size (float),
+  refill_rate : tokens added per second (float),
+  lock : optional lock to hold while using dbConn, if the
+         connection is shared between threads
+  """
+
+  def __init__(self, dbConn, name, capacity, refill_rate, lock=None):
+    self.dbConn = dbConn
+    self.name = name
+    self.capacity = capacity
+    self.refill_rate = refill_rate
+    self.lock = lock if lock is not None else threading.Lock()
+
+    #
+    # create the bucket full if it doesn't exist yet, and pick
+    # up any change to capacity or rate from the config:
+    #
+    sql = """
+      INSERT INTO ratelimits(name, tokens, capacity, refillrate, updatedat)
+                  VALUES(%s, %s, %s, %s, UNIX_TIMESTAMP(NOW(6)))
+      ON DUPLICATE KEY UPDATE capacity=VALUES(capacity), refillrate=VALUES(refillrate);
+    """
+
+    with self.lock:
+      datatier.perform_action(self.dbConn, sql, [name, capacity, capacity, refill_rate])
+
+  def try_acquire(self):
+    """
+    Takes one token if one is available
+
+    Returns
+    -------
+    True if a token was taken, False if not
+    """
+    sql = """
+      UPDATE ratelimits
+         SET tokens = LEAST(capacity, tokens + GREATEST(0, UNIX_TIMESTAMP(NOW(6)) - updatedat) * refillrate) - 1,
+             updatedat = UNIX_TIMESTAMP(NOW(6))
+       WHERE name = %s
+         AND LEAST(capacity, tokens + GREATEST(0, UNIX_TIMESTAMP(NOW(6)) - updatedat) * refillrate) >= 1;
+    """
+
+    with self.lock:
+      modified = datatier.perform_action(self.dbConn, sql, [self.name])
+
+    return modified == 1
+
+  def acquire(self, timeout_secs):
+    """
+    Takes one token, waiting up to timeout_secs for one
+
+    Returns
+    -------
+    True if a token was taken, False if timed out
+    """
+    return wait_for_token(self, timeout_secs)
+
+
+###################################################################
+#
+# LocalTokenBucket:
+#
+# Same as TokenBucket, but kept in memory: only limits callers
+# in this process. Meant for tests and local runs.
+#
+class LocalTokenBucket:
+  """
+  Token bucket kept in memory
+
+  Parameters
+  ----------
+  capacity : maximum number of tokens, i.e. the burst size (float),
+  refill_rate : tokens added per second (float),
+  clock : optional function returning the time in seconds
+  """
+
+  def __init__(self, capacity, refill_rate, clock=time.monotonic):
+    self.capacity = capacity
+    self.refill_rate = refill_rate
+    self.clock = clock
+    self.tokens = capacity
+    self.updatedat = clock()
+    self.lock = threading.Lock()
+
+  def try_acquire(self):
+    """
+    Takes one token if one is available
+
+    Returns
+    -------
+    True if a token was taken, False if not
+    """
+    with self.lock:
+      now = self.clock()
+      self.tokens = min(self.capacity, self.tokens + max(0, now - self.updatedat) * self.refill_rate)
+      self.updatedat = now
+
+      if self.tokens < 1:
+        return False
+
+      self.tokens -= 1
+      return True
+
+  def acquire(self, timeout_secs):
+    """
+    Takes one token, waiting up to timeout_secs for one
+
+    Returns
+    -------
+    True if a token was taken, False if timed out
+    """
+    return wait_for_token(self, timeout_secs)
+
+
+###################################################################
+#
+# wait_for_token:
+#
+# Polls the bucket until a token is taken or the timeout
+# passes, sleeping about as long as it takes to refill one
+# token (with jitter, so waiting lambdas don't retry in step).
+#
+def wait_for_token(bucket, timeout_secs):
+  """
+  Polls bucket.try_acquire until it succeeds or times out
+
+  Returns
+  -------
+  True if a token was taken, False if timed out
+  """
+  deadline = time.time() + timeout_secs
+
+  while True:
+    if bucket.try_acquire():
+      return True
+
+    remaining = deadline - time.time()
+
+    if remaining <= 0:
+      return False
+
+    delay = random.uniform(0.5, 1.5) / bucket.refill_rate if bucket.refill_rate > 0 else remaining
+    time.sleep(min(delay, remaining))
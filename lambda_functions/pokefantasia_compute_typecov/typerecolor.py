@@ -0,0 +1,211 @@
+#
+# typerecolor.py
+#
+# Fast local "type recolor" renderer, used by typecov as a
+# fallback when the remote model is unavailable. Recolors the
+# pokemon towards a palette for the type (color transfer in LAB
+# space), then adds a simple overlay effect for the type. Runs
+# on CPU with OpenCV/NumPy only, well under a second for a
+# 1024x1024 image, and needs no network.
+#
+
+import numpy as np
+import cv2
+
+
+# ------------------------------
+# Type Palettes (BGR)
+# ------------------------------
+
+type_palettes = {
+  "normal":   [(168, 168, 168), (120, 168, 198), (200, 215, 225)],
+  "fire":     [(48, 128, 240), (32, 64, 200), (80, 200, 250)],
+  "water":    [(240, 144, 104), (200, 100, 60), (250, 210, 150)],
+  "electric": [(48, 208, 248), (20, 170, 230), (170, 245, 255)],
+  "grass":    [(80, 200, 120), (40, 150, 70), (140, 230, 170)],
+  "ice":      [(216, 216, 152), (240, 230, 190), (255, 250, 235)],
+  "fighting": [(40, 48, 192), (30, 30, 140), (90, 110, 220)],
+  "poison":   [(160, 64, 160), (120, 40, 120), (210, 140, 210)],
+  "ground":   [(104, 192, 224), (60, 140, 180), (150, 220, 240)],
+  "flying":   [(240, 144, 168), (220, 170, 190), (250, 220, 230)],
+  "psychic":  [(136, 88, 248), (110, 60, 210), (200, 160, 255)],
+  "bug":      [(32, 184, 168), (20, 140, 120), (100, 220, 200)],
+  "rock":     [(56, 160, 184), (40, 120, 140), (120, 200, 215)],
+  "ghost":    [(152, 88, 112), (110, 60, 80), (200, 150, 170)],
+  "dragon":   [(248, 56, 112), (200, 40, 80), (255, 140, 170)],
+  "dark":     [(72, 88, 112), (40, 50, 70), (120, 130, 150)],
+  "steel":    [(208, 184, 184), (170, 150, 150), (235, 225, 225)],
+  "fairy":    [(172, 153, 238), (150, 120, 220), (220, 200, 250)]
+}
+
+type_effects = {
+  "fire": "glow",
+  "electric": "sparkle",
+  "psychic": "glow",
+  "dragon": "glow",
+  "fairy": "sparkle",
+  "ice": "frost",
+  "steel": "frost",
+  "water": "frost",
+  "ghost": "shadow",
+  "dark": "shadow",
+  "poison": "shadow"
+}
+
+
+# ------------------------------
+# Helper Functions
+# ------------------------------
+
+def foreground_mask(input_image, threshold=30):
+    """
+    Estimates which pixels belong to the pokemon, assuming a
+    mostly uniform background: the background color is the
+    median of the image border.
+
+    Parameters:
+    - input_image: The original image (numpy array, BGR).
+    - threshold: Color distance from the background color above
+      which a pixel is foreground.
+
+    Returns:
+    - mask: Float mask in [0, 1], feathered at the edges.
+    """
+    border = np.concatenate([
+        input_image[0, :], input_image[-1, :],
+        input_image[:, 0], input_image[:, -1]
+    ]).astype(np.float32)
+    background = np.median(border, axis=0)
+
+    distance = np.linalg.norm(input_image.astype(np.float32) - background, axis=2)
+    mask = (distance > threshold).astype(np.float32)
+
+    # close small holes and feather the edge
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (7, 7))
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+    mask = cv2.GaussianBlur(mask, (0, 0), 2)
+
+    return mask
+
+def color_transfer(input_image, palette, mask, lightness=0.35):
+    """
+    Moves the colors of the foreground towards the palette, by
+    matching the mean and spread of the a/b channels in LAB
+    space to those of the palette (Reinhard color transfer).
+
+    Parameters:
+    - input_image: The original image (numpy array, BGR).
+    - palette: List of BGR colors for the type.
+    - mask: Foreground mask from foreground_mask.
+    - lightness: How far to shift lightness towards the palette.
+
+    Returns:
+    - recolored: The recolored image (numpy array, BGR).
+    """
+    lab = cv2.cvtColor(input_image, cv2.COLOR_BGR2LAB).astype(np.float32)
+
+    palette_lab = cv2.cvtColor(np.uint8([palette]), cv2.COLOR_BGR2LAB).astype(np.float32)[0]
+    target_mean = palette_lab.mean(axis=0)
+    target_std = palette_lab.std(axis=0) + 6.0
+
+    weights = mask[..., None]
+    total = max(float(mask.sum()), 1.0)
+    source_mean = (lab * weights).sum(axis=(0, 1)) / total
+    source_std = np.sqrt((((lab - source_mean) ** 2) * weights).sum(axis=(0, 1)) / total) + 1e-3
+
+    transferred = lab.copy()
+    for c in (1, 2):
+        transferred[..., c] = (lab[..., c] - source_mean[c]) * (target_std[c] / source_std[c]) + target_mean[c]
+    transferred[..., 0] = lab[..., 0] + (target_mean[0] - source_mean[0]) * lightness
+
+    transferred = cv2.cvtColor(np.clip(transferred, 0, 255).astype(np.uint8), cv2.COLOR_LAB2BGR)
+
+    recolored = transferred.astype(np.float32) * weights + input_image.astype(np.float32) * (1 - weights)
+    return recolored.astype(np.uint8)
+
+def apply_glow(image, mask, color, strength=0.8):
+    """
+    Adds a soft colored aura around the pokemon.
+    """
+    halo = cv2.GaussianBlur(mask, (0, 0), 18)
+    halo = np.clip(halo * 1.5 - mask, 0, 1)[..., None] * strength
+    glow = np.float32(color)
+    result = image.astype(np.float32) * (1 - halo) + glow * halo
+    return result.astype(np.uint8)
+
+def apply_sparkle(image, mask, color, count=60, seed=7):
+    """
+    Adds small bright sparkles over the pokemon.
+    """
+    result = image.copy()
+    ys, xs = np.nonzero(mask > 0.5)
+    if len(xs) == 0:
+        return result
+
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(xs), size=min(count, len(xs)))
+    radius = max(2, image.shape[1] // 200)
+    for i in picks:
+        cv2.circle(result, (int(xs[i]), int(ys[i])), radius, color, -1, cv2.LINE_AA)
+
+    return cv2.addWeighted(result, 0.7, image, 0.3, 0)
+
+def apply_frost(image, mask, color):
+    """
+    Brightens highlights with a cold tint, for a glossy or icy look.
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY).astype(np.float32) / 255.0
+    highlight = (np.clip((gray - 0.55) / 0.45, 0, 1) * mask)[..., None] * 0.6
+    result = image.astype(np.float32) * (1 - highlight) + np.float32(color) * highlight
+    return result.astype(np.uint8)
+
+def apply_shadow(image, mask, color):
+    """
+    Darkens the edges of the image and adds a dark colored rim
+    around the pokemon.
+    """
+    h, w = image.shape[:2]
+    ys, xs = np.ogrid[:h, :w]
+    distance = np.sqrt(((xs - w / 2) / (w / 2)) ** 2 + ((ys - h / 2) / (h / 2)) ** 2)
+    vignette = np.clip(1.15 - 0.5 * distance, 0.45, 1.0).astype(np.float32)[..., None]
+
+    result = apply_glow(image, mask, color, strength=0.6)
+    return (result.astype(np.float32) * vignette).astype(np.uint8)
+
+
+# ------------------------------
+# Renderer
+# ------------------------------
+
+def render_type_recolor(input_image, target_type):
+    """
+    Renders the pokemon as the given type, locally.
+
+    Parameters:
+    - input_image: The original image (numpy array, BGR).
+    - target_type: The type to render, a key of type_palettes.
+
+    Returns:
+    - output_image: The recolored image (numpy array, BGR).
+    """
+    if target_type not in type_palettes:
+        raise Exception(f"Error: '{target_type}' is not a valid Pokémon type.")
+
+    palette = type_palettes[target_type]
+
+    mask = foreground_mask(input_image)
+    output_image = color_transfer(input_image, palette, mask)
+
+    effect = type_effects.get(target_type, "none")
+
+    if effect == "glow":
+        output_image = apply_glow(output_image, mask, palette[2])
+    elif effect == "sparkle":
+        output_image = apply_sparkle(output_image, mask, palette[2])
+    elif effect == "frost":
+        output_image = apply_frost(output_image, mask, palette[2])
+    elif effect == "shadow":
+        output_image = apply_shadow(output_image, mask, palette[1])
+
+    print(f"Type recolor '{target_type}' applied with effect '{effect}'.")
+    return output_image
@@ -0,0 +1,199 @@
+#
+# imagecodec.py
+#
+# Recognizes and decodes the image formats Pokefantasia accepts:
+# JPEG, PNG, WebP, and AVIF where a decoder is available. The
+# format is sniffed from the first bytes of the image, not taken
+# from the file extension.
+#
+# The same module is used by upload and by the compute lambdas.
+# Each of them ships OpenCV or Pillow (or neither), so the
+# decoders are imported on first use.
+#
+
+import io
+
+
+#
+# format -> (extension, content type)
+#
+formats = {
+  "jpeg": (".jpg", "image/jpeg"),
+  "png": (".png", "image/png"),
+  "webp": (".webp", "image/webp"),
+  "avif": (".avif", "image/avif")
+}
+
+#
+# extension -> format
+#
+extensions = {
+  ".jpg": "jpeg",
+  ".jpeg": "jpeg",
+  ".png": "png",
+  ".webp": "webp",
+  ".avif": "avif"
+}
+
+
+###################################################################
+#
+# sniff_format:
+#
+# Recognizes the format from the signature at the start of the
+# image: JPEG SOI marker, PNG signature, RIFF/WEBP container,
+# or an ISO-BMFF ftyp box with an AVIF major or compatible
+# brand.
+#
+def sniff_format(data):
+  """
+  Returns the format of the image, or None if it's not one of
+  the accepted formats
+
+  Parameters
+  ----------
+  data : the image, or at least its first 64 bytes (bytes-like)
+
+  Returns
+  -------
+  "jpeg", "png", "webp", "avif" or None
+  """
+  header = bytes(data[0:64])
+
+  if header[0:3] == b"\xff\xd8\xff":
+    return "jpeg"
+  if header[0:8] == b"\x89PNG\r\n\x1a\n":
+    return "png"
+  if header[0:4] == b"RIFF" and header[8:12] == b"WEBP":
+    return "webp"
+  if header[4:8] == b"ftyp":
+    brands = header[8:int.from_bytes(header[0:4], "big")]
+    if b"avif" in brands or b"avis" in brands:
+      return "avif"
+
+  return None
+
+
+###################################################################
+#
+# format_for_extension:
+#
+def format_for_extension(extension):
+  """
+  Returns the format for a file extension (e.g. ".png"), or None
+  if it's not an accepted format
+  """
+  return extensions.get(extension.lower())
+
+
+###################################################################
+#
+# decode_bgr:
+#
+# Decodes with OpenCV into a BGR numpy array, as the OpenCV
+# based lambdas expect. reduce = 2, 4 or 8 decodes at 1/reduce
+# of the size; for JPEG this is done in the DCT, which is much
+# faster than decoding at full size. AVIF goes through Pillow
+# if this OpenCV build can't decode it.
+#
+def decode_bgr(data, reduce=1):
+  """
+  Decodes an image into a BGR numpy array
+
+  Parameters
+  ----------
+  data : the image (bytes-like),
+  reduce : 1, 2, 4 or 8, decode at 1/reduce of the size
+
+  Returns
+  -------
+  numpy array of shape (height, width, 3)
+  """
+  import cv2
+  import numpy as np
+
+  flags = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+  }
+
+  image = cv2.imdecode(np.frombuffer(data, np.uint8), flags[reduce])
+
+  if image is None and sniff_format(data) == "avif":
+    image = np.array(decode_pil(data))[:, :, ::-1]
+
+    if reduce > 1:
+      (height, width) = image.shape[0:2]
+      image = cv2.resize(image, (width // reduce, height // reduce), interpolation=cv2.INTER_AREA)
+
+  if image is None:
+    raise Exception("unable to decode image")
+
+  return image
+
+
+###################################################################
+#
+# decode_pil:
+#
+# Decodes with Pillow into an RGB image. Given a size, a JPEG is
+# decoded at the smallest 1/2, 1/4 or 1/8 scale that is still at
+# least that size (Pillow's draft mode), for callers that are
+# going to downscale anyway.
+#
+def decode_pil(data, size=None):
+  """
+  Decodes an image into an RGB PIL image
+
+  Parameters
+  ----------
+  data : the image (bytes-like),
+  size : optional (width, height) the caller needs at least
+
+  Returns
+  -------
+  PIL.Image in RGB mode
+  """
+  from PIL import Image
+
+  if sniff_format(data) == "avif":
+    load_avif_plugin()
+
+  image = Image.open(io.BytesIO(data))
+
+  if size is not None and image.format == "JPEG":
+    image.draft("RGB", size)
+
+  return image.convert("RGB")
+
+
+###################################################################
+#
+# avif_supported:
+#
+# AVIF needs Pillow 11.3+ or the pillow-avif-plugin package.
+#
+def avif_supported():
+  """
+  Returns True if AVIF images can be decoded here
+  """
+  try:
+    from PIL import features
+  except ImportError:
+    return False
+
+  return load_avif_plugin() or features.check("avif") is True
+
+
+def load_avif_plugin():
+  """
+  Registers the pillow-avif-plugin decoder, if it's installed;
+  returns True if it is
+  """
+  try:
+    import pillow_avif  # noqa: F401
+    return True
+  except ImportError:
+    return False
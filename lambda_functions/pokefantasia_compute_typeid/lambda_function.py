@@ -5,6 +5,7 @@ import uuid
 import base64
 import pathlib
 import datatier
+import imagecodec
 import urllib.parse
 import string
 from PIL import Image
@@ -15,8 +16,10 @@ from configparser import ConfigParser
 
 
 def preprocess_image(image_path, image_mean, image_std):
-    # Load image
-    image = Image.open(image_path).convert("RGB")
+    # Load image (JPEG, PNG, WebP or AVIF); a large JPEG is
+    # decoded at reduced scale since it's resized to 224 anyway
+    with open(image_path, "rb") as infile:
+        image = imagecodec.decode_pil(infile.read(), (224, 224))
 
     # Resize to match model input
     image = image.resize((224, 224))
@@ -102,21 +105,18 @@ def lambda_handler(event, context):
           
         extension = pathlib.Path(bucketkey).suffix
         
-        if extension != ".jpeg" and extension != ".jpg" : 
-          raise Exception("expecting S3 document to have .jpeg extension")
+        if imagecodec.format_for_extension(extension) is None:
+          raise Exception("expecting S3 document to be a JPEG, PNG, WebP or AVIF image")
         
-        if extension == ".jpeg":
-            bucketkey_results_file = bucketkey[:-5] + ".txt"
-        elif extension == ".jpg":
-            bucketkey_results_file = bucketkey[:-4] + ".txt"
+        bucketkey_results_file = bucketkey[:-len(extension)] + ".txt"
         
         print("bucketkey results file:", bucketkey_results_file)
           
         #
-        # download JPEG from S3 to LOCAL file system:
+        # download image from S3 to LOCAL file system:
         #
         print("**DOWNLOADING '", bucketkey, "'**")
-        local_file = "/tmp/data.jpeg"
+        local_file = "/tmp/data" + extension
         image_path = local_file
         bucket.download_file(bucketkey, local_file)
         
@@ -154,8 +154,10 @@ def lambda_handler(event, context):
             'predicted_type': predicted_class,
         }
 
-        sql = "UPDATE jobs SET status='completed', resultsfilekey=%s WHERE datafilekey=%s;"
-        datatier.perform_action(dbConn, sql, [bucketkey_results_file, bucketkey])
+        # The result is small, so it's also stored in the row for
+        # download to serve without going to S3
+        sql = "UPDATE jobs SET status='completed', resultsfilekey=%s, result=%s WHERE datafilekey=%s;"
+        datatier.perform_action(dbConn, sql, [bucketkey_results_file, json.dumps(result), bucketkey])
 
         # Save results back to S3
         print("Uploading results to S3")
@@ -187,8 +189,8 @@ def lambda_handler(event, context):
 
         # Update job status to "error" in the database
         dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
-        sql = "UPDATE jobs SET status='error', resultsfilekey=%s WHERE datafilekey=%s;"
-        datatier.perform_action(dbConn, sql, [bucketkey_results_file, bucketkey])
+        sql = "UPDATE jobs SET status='error', resultsfilekey=%s, errormsg=%s WHERE datafilekey=%s;"
+        datatier.perform_action(dbConn, sql, [bucketkey_results_file, str(e)[:1024], bucketkey])
 
         return {
             'statusCode': 500,
@@ -3,20 +3,550 @@
 # the status, and based on the status returns results
 # to the client. The status can be: uploaded, processing,
 # completed, or error. In the case of completed, the 
-# analysis results are returned as a list. In the case
-# of error, the error message from the results file is
-# returned.
+# client gets a short-lived presigned URL to download the
+# results from S3, with their content type and size; small
+# text results (typeid) are returned inline, straight from the
+# jobs row when the compute lambda stored them there. In the
+# case of error, the error message is returned, from the jobs
+# row or else from the results file. With wait=N, the request
+# waits up to N seconds for the job to finish before answering.
+#
+# Results carry their S3 ETag: a request with If-None-Match
+# set to it gets a 304 and no body if the results haven't
+# changed, and inline results can be fetched in byte ranges.
+#
+# With size=thumb or size=medium, image results are returned as
+# a downscaled rendition instead, made on first request and
+# cached in the output bucket (see renditions).
+#
+# Rows of completed jobs and small results are immutable, so
+# they are also cached in memory across requests (see
+# resultcache), sparing RDS and S3 for popular results. Jobids
+# start over after a reset, so cached rows are tied to the
+# latest reset of the database, which is re-read at most every
+# few seconds rather than on every request.
+#
+# Given a list of jobids instead of a jobid, returns the same
+# for every job, from one query and with the results fetched
+# concurrently; a failure on one job doesn't fail the others.
 #
 
 import json
 import boto3
 import os
 import base64
+import hashlib
+import time
 import datatier
+import resultcache
 
+from botocore.exceptions import ClientError
 from configparser import ConfigParser
+from concurrent.futures import ThreadPoolExecutor
+
+#
+# output bucket of each action, as named in the jobs table
+#
+output_buckets = {
+  "bucket_typeid": "poketypeid-output",
+  "bucket_typecov": "poketypecov-output",
+  "bucket_formatcov": "pokeformatcov-output"
+}
+
+#
+# columns of jobs read for a download, by name, so the columns
+# of the table can change without breaking the download
+#
+columns = ["jobid", "userid", "status", "originaldatafile", "datafilekey", "resultsfilekey", "bucket",
+           "fallback", "result", "errormsg"]
+
+#
+# cache of completed job rows and small results, created on
+# the first request (see resultcache)
+#
+result_cache = None
+
+#
+# latest resetid of the database, and until when it is trusted
+# without reading it again (see reset_generation)
+#
+generation = None
+generation_expires = 0
+
+
+def get_parameter(event, name, default):
+  """
+  Returns the named parameter from the event, the URL path
+  ("pathParameters") or the query string, or default if absent
+  """
+  if name in event:
+    return event[name]
+  for params in ("pathParameters", "queryStringParameters"):
+    if event.get(params) and name in event[params]:
+      return event[params][name]
+  return default
+
+
+def read_result(s3_client, bucket, key):
+  """
+  Reads a (small) results object from the bucket into memory
+  """
+  cached = result_cache.get(("object", bucket, key))
+
+  if cached is not None:
+    return cached[0]
+
+  response = s3_client.get_object(Bucket=bucket, Key=key)
+  data = response['Body'].read()
+
+  result_cache.put(("object", bucket, key), (data, response['ETag']), len(data))
+
+  return data
+
+
+def not_modified(err):
+  """
+  True if the S3 error is a 304 Not Modified answer to a
+  conditional request
+  """
+  return err.response['Error']['Code'] in ('304', 'NotModified')
+
+
+def get_result(s3_client, bucket, key, if_none_match=None, byte_range=None):
+  """
+  GETs a results object, only if its ETag differs from
+  if_none_match (when given), and only the byte_range (when
+  given, e.g. "bytes=0-1023").
+
+  Returns
+  -------
+  the S3 response, or None if the object still has the ETag
+  if_none_match, in which case S3 sent no body
+  """
+  args = {'Bucket': bucket, 'Key': key}
+
+  if if_none_match is not None:
+    args['IfNoneMatch'] = if_none_match
+  if byte_range is not None:
+    args['Range'] = byte_range
+
+  try:
+    return s3_client.get_object(**args)
+  except ClientError as err:
+    if not_modified(err):
+      return None
+    raise
+
+
+def presigned_result(s3_client, bucket, key, expires_secs, if_none_match=None):
+  """
+  Returns a presigned GET URL for a results object, valid for
+  expires_secs, along with its content type, size and ETag, so
+  the client downloads the results straight from S3 (which
+  also serves byte ranges of them). Returns None if the object
+  still has the ETag if_none_match.
+  """
+  #
+  # the content type, size and ETag of a results object never
+  # change, so once known they are taken from the cache:
+  #
+  head = result_cache.get(("head", bucket, key))
+
+  if head is None:
+    args = {'Bucket': bucket, 'Key': key}
+
+    if if_none_match is not None:
+      args['IfNoneMatch'] = if_none_match
+
+    try:
+      response = s3_client.head_object(**args)
+    except ClientError as err:
+      if not_modified(err):
+        return None
+      raise
+
+    head = (response.get('ContentType', ''), response['ContentLength'], response['ETag'])
+
+    result_cache.put(("head", bucket, key), head)
+  elif if_none_match == head[2]:
+    return None
+
+  url = s3_client.generate_presigned_url('get_object',
+                                         Params={'Bucket': bucket, 'Key': key},
+                                         ExpiresIn=expires_secs)
+
+  return {
+    'url': url,
+    'content_type': head[0],
+    'size': head[1],
+    'etag': head[2],
+    'expires_in': expires_secs
+  }
+
+
+def rendition_of(s3_client, bucket, key, rendition):
+  """
+  Returns the key of the rendition (size, max_px, quality) of
+  a results image, making it if need be (see renditions)
+  """
+  import renditions
+
+  rendition_key = result_cache.get(("rendition", bucket, key, rendition))
+
+  if rendition_key is None:
+    rendition_key = renditions.get_rendition(s3_client, bucket, key, *rendition)
+    result_cache.put(("rendition", bucket, key, rendition), rendition_key)
+
+  return rendition_key
+
+
+def reset_generation(dbConn):
+  """
+  Returns the id of the latest reset of the database; cached
+  job rows are only valid under the resetid they were read in
+  """
+  row = datatier.retrieve_one_row(dbConn, "SELECT MAX(resetid) FROM resets;")
+
+  return row[0]
+
+
+def wait_for_jobs(dbConn, jobids, wait_secs):
+  """
+  Waits up to wait_secs for the jobs to leave the uploaded and
+  processing states, polling just their status with exponential
+  backoff (0.25 seconds, doubling up to 2 seconds). Returns as
+  soon as none of the jobs is pending any more.
+  """
+  deadline = time.time() + wait_secs
+  delay = 0.25
+  polls = 0
+
+  sql = "SELECT COUNT(*) FROM jobs WHERE jobid IN (" + ", ".join(["%s"] * len(jobids)) + ")"
+  sql += " AND status IN ('uploaded', 'processing');"
+
+  while True:
+    #
+    # end the current transaction, or the SELECT would keep
+    # reading the same snapshot of the jobs table:
+    #
+    dbConn.commit()
+
+    row = datatier.retrieve_one_row(dbConn, sql, jobids)
+    polls += 1
+
+    if row[0] == 0:
+      break
+
+    remaining = deadline - time.time()
+
+    if remaining <= 0:
+      break
+
+    time.sleep(min(delay, remaining))
+    delay = min(delay * 2, 2.0)
+
+  print("waited", polls, "polls for", len(jobids), "job(s)")
+
+
+def job_results(s3_client, job, targets, delivery, expires_secs, if_none_match=None, byte_range=None, rendition=None):
+  """
+  Works out the response for one job from its row in the jobs
+  table, and for a multi-type typecov job its rows in
+  jobtargets.
+
+  Parameters
+  ----------
+  s3_client : S3 client (thread-safe),
+  job : the job's row from jobs, as a dict of the columns,
+  targets : list of (targettype, status, resultsfilekey,
+    fallback, errormsg) of the job, [] if not a multi-type job,
+  delivery : "url", "inline", or None for the default,
+  expires_secs : lifetime of presigned URLs,
+  if_none_match : optional ETag the client already has of the
+    results of a (single-result) completed job,
+  byte_range : optional byte range of inline results,
+  rendition : optional (size, max_px, quality) of the rendition
+    to return of image results instead of the full size
+
+  Returns
+  -------
+  (statusCode, body) where body is a dict
+  """
+  jobid = job["jobid"]
+  status = job["status"]
+  original_data_file = job["originaldatafile"]
+  results_file_key = job["resultsfilekey"]
+  bucket_name = job["bucket"]
+  fallback = job["fallback"] == 1
+  inline_result = job["result"]
+  inline_errormsg = job["errormsg"]
+
+  if bucket_name not in output_buckets:
+    raise Exception("Error with bucket_name in database")
+
+  bucket = output_buckets[bucket_name]
+
+  action = bucket_name[len("bucket_"):]
+
+  if delivery is None:
+    delivery = "inline" if action == "typeid" else "url"
+
+  print("job", jobid, "status:", status)
+  print("original data file:", original_data_file)
+  print("results file key:", results_file_key)
+
+  #
+  # what's the status of the job? There should be 4 cases:
+  #   uploaded
+  #   processing - ...
+  #   completed
+  #   error
+  #
+  if status == "uploaded":
+    print("**No results yet, returning...**")
+    #
+    return (480, {
+      'text': status
+    })
+
+  if status == "processing":
+    print("**No results yet, returning...**")
+    #
+    # a multi-type typecov job reports the progress of each
+    # type:
+    #
+    if len(targets) > 0:
+      return (481, {
+        'text': status,
+        'targets': {t[0]: t[1] for t in targets}
+      })
+
+    return (481, {
+      'text': status
+    })
+
+  #
+  # completed or error, these should have results:
+  #
+
+  if status == 'error':
+    #
+    # the compute lambdas store the error message in the row;
+    # jobs from before they did have it only in the results
+    # file:
+    #
+    if inline_errormsg is not None:
+      lines = inline_errormsg.splitlines()
+      msg = "error: " + (lines[0] if len(lines) > 0 else "unknown")
+      #
+      print("**Job status 'error', row msg:", msg)
+      #
+      return (482, {
+        'text': msg
+      })
+
+    #
+    # otherwise let's download the results if available, and
+    # return the error message in the results file:
+    #
+    if results_file_key == "":
+      print("**Job status 'unknown error', returning...**")
+      #
+      return (482, {
+        'text': 'error: unknown'
+      })
+
+    print("**Job status 'error', downloading error results from S3**")
+    #
+    lines = read_result(s3_client, bucket, results_file_key).decode(errors="replace").splitlines()
+    #
+    if len(lines) == 0:
+      print("**Job status 'unknown error', given empty results file, returning...**")
+      #
+      return (482, {
+        'text': 'error: unknown, results file was empty'
+      })
+
+    msg = "error: " + lines[0]
+    #
+    print("**Job status 'error', results msg:", msg)
+    #
+    return (482, {
+      'text': msg
+    })
+
+  #
+  # at this point, either completed or something unexpected:
+  #
+  if status != "completed":
+    print("**Job status is an unexpected value:", status)
+    #
+    msg = "error: unexpected job status of '" + status + "'"
+    #
+    return (482, {
+      'text': msg
+    })
+
+  #
+  # a completed multi-type job returns the image of every
+  # type that completed (a presigned URL each, or inline),
+  # and the error message of every type that failed:
+  #
+  if len(targets) > 0:
+    print("**Getting results of", len(targets), "types from S3**")
+
+    images = {}
+    errors = {}
+    fallbacks = []
+
+    for (target_type, target_status, target_key, target_fallback, target_errormsg) in targets:
+      if target_status == "completed":
+        if rendition is not None:
+          target_key = rendition_of(s3_client, bucket, target_key, rendition)
+        if delivery == "url":
+          images[target_type] = presigned_result(s3_client, bucket, target_key, expires_secs)
+        else:
+          images[target_type] = base64.b64encode(read_result(s3_client, bucket, target_key)).decode()
+        if target_fallback == 1:
+          fallbacks.append(target_type)
+      else:
+        if target_errormsg is not None:
+          lines = target_errormsg.splitlines()
+        else:
+          lines = read_result(s3_client, bucket, target_key).decode(errors="replace").splitlines()
+        errors[target_type] = "error: " + (lines[0] if len(lines) > 0 else "unknown")
+
+    return (200, {
+      'action': action,
+      'images': images,
+      'errors': errors,
+      'fallbacks': fallbacks
+    })
+
+  #
+  # if we get here, the job completed. Image results can be
+  # asked for as a smaller rendition:
+  #
+  if rendition is not None and bucket_name != "bucket_typeid":
+    results_file_key = rendition_of(s3_client, bucket, results_file_key, rendition)
+
+  #
+  # Hand out a presigned
+  # URL for the results, so they never pass through this
+  # lambda:
+  #
+  if delivery == "url":
+    print("**Presigning results URL**")
+
+    result = presigned_result(s3_client, bucket, results_file_key, expires_secs, if_none_match)
+
+    if result is None:
+      print("**Results not modified, returning...**")
+      return (304, {'etag': if_none_match})
+
+    result['action'] = action
+
+    if bucket_name == "bucket_typecov":
+      result['fallback'] = fallback
+
+    return (200, result)
+
+  #
+  # a typeid result stored in the row is returned from there,
+  # with no trip to S3. Its ETag is the MD5 of the result, the
+  # same as S3 gives the results file:
+  #
+  if inline_result is not None and byte_range is None:
+    print("**Returning results from the jobs row**")
+
+    result_bytes = inline_result.encode()
+    etag = '"' + hashlib.md5(result_bytes).hexdigest() + '"'
+
+    if if_none_match == etag:
+      print("**Results not modified, returning...**")
+      return (304, {'etag': if_none_match})
+
+    return (200, {
+      'text': base64.b64encode(result_bytes).decode(),
+      'etag': etag
+    })
+
+  #
+  # otherwise return the results inline, so we should have
+  # results to download and return to the user (unless the
+  # client has them already). Small results are cached whole,
+  # and a range of them is not:
+  #
+  cached = result_cache.get(("object", bucket, results_file_key)) if byte_range is None else None
+
+  if cached is not None:
+    print("**Results from the cache**")
+
+    (bytes, etag) = cached
+    content_range = None
+
+    if if_none_match == etag:
+      print("**Results not modified, returning...**")
+      return (304, {'etag': if_none_match})
+  else:
+    print("**Downloading results from S3**")
+
+    response = get_result(s3_client, bucket, results_file_key, if_none_match, byte_range)
+
+    if response is None:
+      print("**Results not modified, returning...**")
+      return (304, {'etag': if_none_match})
+
+    bytes = response['Body'].read()
+    etag = response['ETag']
+    content_range = response.get('ContentRange')
+
+    if byte_range is None:
+      result_cache.put(("object", bucket, results_file_key), (bytes, etag), len(bytes))
+
+  #
+  # now encode the data as base64. Note b64encode returns
+  # a bytes object, not a string. So then we have to convert
+  # (decode) the bytes -> string, and then we can serialize
+  # the string as JSON for download:
+  #
+  data = base64.b64encode(bytes)
+  datastr = data.decode()
+
+  if bucket_name == "bucket_typeid":
+    body = {
+      'text': datastr
+    }
+  elif bucket_name == "bucket_typecov":
+    #
+    # typecov results rendered by the local fallback while
+    # the remote model was unavailable are flagged:
+    #
+    body = {
+      'image': datastr,
+      'fallback': fallback
+    }
+  else:
+    body = {
+      'image': datastr
+    }
+
+  body['etag'] = etag
+
+  #
+  # a byte range is a 206 with the range and the full size:
+  #
+  if content_range is not None:
+    body['content_range'] = content_range
+    body['size'] = int(content_range.split("/")[-1])
+    return (206, body)
+
+  return (200, body)
+
 
 def lambda_handler(event, context):
+  global result_cache, generation, generation_expires
+
   try:
     print("**STARTING**")
     print("**lambda: pokefantasia_download**")
@@ -31,16 +561,13 @@ def lambda_handler(event, context):
     configur.read(config_file)
     
     #
-    # configure for S3 access:
+    # configure for S3 access (read-write, to cache
+    # renditions):
     #
-    s3_profile = 's3readonly'
+    s3_profile = 's3readwrite'
     boto3.setup_default_session(profile_name=s3_profile)
     
-    s3 = boto3.resource('s3')
-    
-    bucket_typeid = s3.Bucket("poketypeid-output")
-    bucket_typecov = s3.Bucket("poketypecov-output")
-    bucket_formatcov = s3.Bucket("pokeformatcov-output")
+    s3_client = boto3.client('s3')
     
     #
     # configure for RDS access
@@ -53,208 +580,252 @@ def lambda_handler(event, context):
     
     #
     # jobid from event: could be a parameter
-    # or could be part of URL path ("pathParameters"):
+    # or could be part of URL path ("pathParameters").
+    # Or a batch: jobids, as a list or comma-separated:
     #
-    if "jobid" in event:
-      jobid = event["jobid"]
+    jobids = get_parameter(event, "jobids", None)
+
+    batch = jobids is not None
+
+    if batch:
+      if not isinstance(jobids, list):
+        jobids = str(jobids).split(",")
+
+      jobids = [str(jobid).strip() for jobid in jobids if str(jobid).strip() != ""]
+
+      max_batch_jobs = configur.getint('download', 'max_batch_jobs', fallback=100)
+
+      if len(jobids) == 0:
+        raise Exception("requires at least one jobid in jobids")
+      if len(jobids) > max_batch_jobs:
+        raise Exception("too many jobids, max is " + str(max_batch_jobs))
+    elif "jobid" in event:
+      jobids = [event["jobid"]]
     elif "pathParameters" in event:
       if "jobid" in event["pathParameters"]:
-        jobid = event["pathParameters"]["jobid"]
+        jobids = [event["pathParameters"]["jobid"]]
       else:
         raise Exception("requires jobid parameter in pathParameters")
     else:
         raise Exception("requires jobid parameter in event")
         
-    print("jobid:", jobid)
+    print("jobids:", jobids)
 
     #
-    # does the jobid exist?  What's the status of the job if so?
+    # how to deliver the results: "url" (a presigned URL) or
+    # "inline" (in the response body). By default only typeid
+    # results, which are short text, are inline:
+    #
+    delivery = get_parameter(event, "delivery", None)
+
+    if delivery not in (None, "url", "inline"):
+      raise Exception("delivery must be url or inline")
+
+    expires_secs = configur.getint('download', 'presigned_expires_secs', fallback=300)
+
     #
-    # open connection to the database:
+    # conditional and partial requests, from the HTTP headers
+    # or as parameters:
     #
-    print("**Opening connection**")
-    
-    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    headers = {k.lower(): v for (k, v) in (event.get("headers") or {}).items()}
+
+    if_none_match = headers.get("if-none-match", get_parameter(event, "etag", None))
+    byte_range = headers.get("range", get_parameter(event, "range", None))
+
+    if byte_range is not None and not byte_range.startswith("bytes="):
+      raise Exception("range must be of the form bytes=start-end")
 
     #
-    # first we need to make sure the userid is valid:
+    # size=thumb or size=medium asks for a rendition of image
+    # results:
     #
-    print("**Checking if jobid is valid**")
-    
-    sql = "SELECT * FROM jobs WHERE jobid = %s;"
-    
-    row = datatier.retrieve_one_row(dbConn, sql, [jobid])
-    
-    if row == ():  # no such job
-      print("**No such job, returning...**")
-      return {
-        'statusCode': 400,
-        'body': json.dumps({
-          'text': 'no such job...'
-        })
-      }
-    
-    print(row)
-    
-    status = row[2]
-    original_data_file = row[3]
-    results_file_key = row[5]
-    bucket_name = row[6]
-    
-    if bucket_name == "bucket_typeid":
-      bucket = bucket_typeid
-    elif bucket_name == "bucket_typecov":
-      bucket = bucket_typecov
-    elif bucket_name == "bucket_formatcov":
-      bucket = bucket_formatcov
-    else:
-      raise Exception("Error with bucket_name in database")
-    
-    
-    print("job status:", status)
-    print("original data file:", original_data_file)
-    print("results file key:", results_file_key)
-    
+    size = get_parameter(event, "size", None)
+    rendition = None
+
+    if size is not None and size != "full":
+      if size not in ("thumb", "medium"):
+        raise Exception("size must be thumb, medium or full")
+
+      rendition = (size,
+                   configur.getint('renditions', size + '_px', fallback=256 if size == "thumb" else 1024),
+                   configur.getint('renditions', 'quality', fallback=80))
+
     #
-    # what's the status of the job? There should be 4 cases:
-    #   uploaded
-    #   processing - ...
-    #   completed
-    #   error
+    # long poll: with wait=N the request is held open up to N
+    # seconds (capped by max_wait_secs, and by the time this
+    # lambda has left less a few seconds to answer) until the
+    # jobs are no longer uploaded/processing:
     #
-    if status == "uploaded":
-      print("**No results yet, returning...**")
-      #
-      return {
-        'statusCode': 480,
-        'body': json.dumps({
-          'text': status
-        })
-      }
+    wait_secs = float(get_parameter(event, "wait", 0))
 
-    if status == "processing":
-      print("**No results yet, returning...**")
-      #
-      return {
-        'statusCode': 481,
-        'body': json.dumps({
-          'text': status
-        })
-      }
+    max_wait_secs = configur.getfloat('download', 'max_wait_secs', fallback=25)
+    wait_secs = min(wait_secs, max_wait_secs)
+
+    if context is not None:
+      wait_secs = min(wait_secs, context.get_remaining_time_in_millis() / 1000 - 3)
+
+    #
+    # rows of completed jobs come from the cache when they can,
+    # along with their jobtargets rows:
+    #
+    if result_cache is None:
+      result_cache = resultcache.LRUCache(configur.getint('cache', 'max_bytes', fallback=64 * 1024 * 1024),
+                                          configur.getint('cache', 'max_item_bytes', fallback=256 * 1024),
+                                          configur.getint('cache', 'ttl_secs', fallback=600))
 
     #
-    # completed or error, these should have results:
+    # the reset generation is read at most every
+    # generation_ttl_secs, so a request whose jobs are all cached
+    # usually doesn't touch the database at all; a reset is seen
+    # by warm containers within that many seconds:
     #
+    dbConn = None
 
-    if status == 'error':
+    if generation is None or generation_expires < time.time():
+      print("**Opening connection**")
+
+      dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+
+      generation = reset_generation(dbConn)
+      generation_expires = time.time() + configur.getfloat('cache', 'generation_ttl_secs', fallback=5)
+
+    rows_by_jobid = {}
+    targets = {}
+
+    for jobid in jobids:
+      cached = result_cache.get(("job", generation, str(jobid)))
+
+      if cached is not None:
+        rows_by_jobid[str(jobid)] = cached[0]
+        if len(cached[1]) > 0:
+          targets[str(jobid)] = cached[1]
+
+    uncached_jobids = [jobid for jobid in jobids if str(jobid) not in rows_by_jobid]
+
+    print(len(jobids) - len(uncached_jobids), "job(s) from the cache")
+
+    #
+    # does the jobid exist?  What's the status of the job if so?
+    #
+    if len(uncached_jobids) > 0:
       #
-      # let's download the results if available, and return the
-      # error message in the results file:
+      # open connection to the database, unless it already is:
       #
-      if results_file_key == "":
-        print("**Job status 'unknown error', returning...**")
-        #
-        return {
-          'statusCode': 482,
-          'body': json.dumps({
-            'text': 'error: unknown'
-          })
-        }
-      
-      local_filename = "/tmp/results.txt"
+      if dbConn is None:
+        print("**Opening connection**")
+
+        dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+
+      if wait_secs > 0:
+        print("**Waiting up to", wait_secs, "seconds for jobs to finish**")
+        wait_for_jobs(dbConn, uncached_jobids, wait_secs)
+
       #
-      print("**Job status 'error', downloading error results from S3**")
+      # first we need to make sure the jobids are valid, all
+      # with one query:
       #
-      bucket.download_file(results_file_key, local_filename)
+      print("**Checking if jobids are valid**")
+      
+      sql = "SELECT " + ", ".join(columns) + " FROM jobs WHERE jobid IN (" + ", ".join(["%s"] * len(uncached_jobids)) + ");"
+      
+      rows = datatier.retrieve_all_rows(dbConn, sql, uncached_jobids)
+
+      jobs = [dict(zip(columns, row)) for row in rows]
+      
+      rows_by_jobid.update({str(job["jobid"]): job for job in jobs})
+      
       #
-      infile = open(local_filename, "r")
-      lines = infile.readlines()
-      infile.close()
+      # a multi-type typecov job has one row per type in
+      # jobtargets, with the progress of that type:
       #
-      if len(lines) == 0:
-        print("**Job status 'unknown error', given empty results file, returning...**")
-        #
-        return {
-          'statusCode': 482,
-          'text': json.dumps("error: unknown, results file was empty")
-        }
+      typecov_jobids = [job["jobid"] for job in jobs if job["bucket"] == "bucket_typecov"]
         
-      msg = "error: " + lines[0]
+      if len(typecov_jobids) > 0:
+        sql = "SELECT jobid, targettype, status, resultsfilekey, fallback, errormsg FROM jobtargets WHERE jobid IN ("
+        sql += ", ".join(["%s"] * len(typecov_jobids)) + ") ORDER BY jobid, targettype;"
+
+        for target in datatier.retrieve_all_rows(dbConn, sql, typecov_jobids):
+          targets.setdefault(str(target[0]), []).append(target[1:])
+
       #
-      print("**Job status 'error', results msg:", msg)
-      print("**Returning error msg to client...")
+      # a completed job no longer changes; jobs still uploaded
+      # or processing are never cached:
       #
-      return {
-        'statusCode': 482,
-        'body': json.dumps({
-          'text': msg
-        })
-      }
+      for job in jobs:
+        if job["status"] == "completed":
+          result_cache.put(("job", generation, str(job["jobid"])), (job, targets.get(str(job["jobid"]), [])))
     
     #
-    # at this point, either completed or something unexpected:
+    # a single job answers with its own status code:
     #
-    if status != "completed":
-      print("**Job status is an unexpected value:", status)
-      print("**Returning to client...**")
+    if not batch:
+      jobid = str(jobids[0])
+
+      if jobid not in rows_by_jobid:  # no such job
+        print("**No such job, returning...**")
+        return {
+          'statusCode': 400,
+          'body': json.dumps({
+            'text': 'no such job...'
+          })
+        }
+      
+      print(rows_by_jobid[jobid])
+
+      (statusCode, body) = job_results(s3_client, rows_by_jobid[jobid], targets.get(jobid, []), delivery, expires_secs,
+                                       if_none_match, byte_range, rendition)
+
+      print("**DONE, returning results**")
+
       #
-      msg = "error: unexpected job status of '" + status + "'"
+      # respond in an HTTP-like way, i.e. with a status
+      # code and body in JSON format; results also carry
+      # their ETag as a header, and a 304 has no body:
       #
-      return {
-        'statusCode': 482,
-        'body': json.dumps({
-          'text': msg
-        })
+      response = {
+        'statusCode': statusCode,
+        'body': json.dumps(body) if statusCode != 304 else ''
       }
-      
-    #
-    # if we get here, the job completed. So we should have results
-    # to download and return to the user:
-    #      
-    local_filename = "/tmp/results.txt"
-    
-    print("**Downloading results from S3**")
-    
-    bucket.download_file(results_file_key, local_filename)
-    
-  
+
+      if 'etag' in body:
+        response['headers'] = {'ETag': body['etag']}
+
+      return response
+
     #
-    # open the file and read as raw bytes:
+    # a batch gets the results of every job, fetched from S3
+    # concurrently. Each job has its own status code, and an
+    # exception on one job only fails that job:
     #
-    infile = open(local_filename, "rb")
-    bytes = infile.read()
-    infile.close()
+    print("**Getting results of", len(rows_by_jobid), "jobs**")
+
+    batch_concurrency = configur.getint('download', 'batch_concurrency', fallback=16)
+      
+    def results_of(jobid):
+      if jobid not in rows_by_jobid:
+        return (400, {'text': 'no such job...'})
+      try:
+        return job_results(s3_client, rows_by_jobid[jobid], targets.get(jobid, []), delivery, expires_secs,
+                           rendition=rendition)
+      except Exception as err:
+        print("**ERROR on job", jobid, ":", str(err))
+        return (500, {'text': str(err)})
+        
+    with ThreadPoolExecutor(max_workers=min(batch_concurrency, len(jobids))) as executor:
+      results = list(executor.map(results_of, jobids))
     
-    #
-    # now encode the data as base64. Note b64encode returns
-    # a bytes object, not a string. So then we have to convert
-    # (decode) the bytes -> string, and then we can serialize
-    # the string as JSON for download:
-    #
-    data = base64.b64encode(bytes)
-    datastr = data.decode()
+    jobs = []
+    for (jobid, (statusCode, body)) in zip(jobids, results):
+      jobs.append(dict(body, jobid=jobid, statusCode=statusCode))
 
     print("**DONE, returning results**")
     
-    #
-    # respond in an HTTP-like way, i.e. with a status
-    # code and body in JSON format:
-    #
-    
-    if bucket_name == "bucket_typeid":
-      return {
-        'statusCode': 200,
-        'body': json.dumps({
-          'text': datastr
-        })
-      }
-    else:
-      return {
-        'statusCode': 200,
-        'body': json.dumps({
-          'image': datastr
-        })
-      }
+    return {
+      'statusCode': 200,
+      'body': json.dumps({
+        'jobs': jobs
+      })
+    }
     
 
   #
@@ -268,3 +839,10 @@ def lambda_handler(event, context):
       'statusCode': 500,
       'body': json.dumps(str(err))
     }
+
+  #
+  # either way, report how the cache did:
+  #
+  finally:
+    if result_cache is not None:
+      result_cache.emit_metrics("Pokefantasia", "pokefantasia_download")
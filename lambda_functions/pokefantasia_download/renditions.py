@@ -0,0 +1,190 @@
+#
+# renditions.py
+#
+# Derived renditions of result images, for views that don't
+# need the full size (e.g. a gallery): the image is downscaled
+# to fit the rendition's maximum size and re-encoded in its own
+# format (see imagecodec). Each rendition is made on the first
+# request for it and cached in the output bucket, next to the
+# results, under a key derived from the results key. When the
+# rendition wouldn't be smaller than the results (e.g. a
+# 1024 px typecov image asked for at medium), the results
+# themselves are served and nothing is stored.
+#
+# Needs Pillow in the download lambda (e.g. as a layer).
+#
+
+import io
+import imagecodec
+
+from botocore.exceptions import ClientError
+from PIL import Image
+
+
+#
+# bytes fetched from the start of the results to read the image
+# size from its header
+#
+HEADER_BYTES = 64 * 1024
+
+#
+# imagecodec format -> Pillow format and encoder options
+#
+save_options = {
+  "jpeg": ("JPEG", {"optimize": True}),
+  "png": ("PNG", {"optimize": True}),
+  "webp": ("WEBP", {"method": 4}),
+  "avif": ("AVIF", {})
+}
+
+
+###################################################################
+#
+# rendition_key:
+#
+# e.g. "ash/e-fire.jpg" -> "renditions/thumb/ash/e-fire.jpg",
+# so a rendition keeps the extension (and so the format) of the
+# results.
+#
+def rendition_key(results_key, size):
+  """
+  Returns the key a rendition of the results is cached under
+  """
+  return "renditions/" + size + "/" + results_key
+
+
+###################################################################
+#
+# render:
+#
+def render(data, max_px, quality):
+  """
+  Downscales an image to fit max_px x max_px, keeping the aspect
+  ratio
+
+  Parameters
+  ----------
+  data : the image (bytes),
+  max_px : maximum width and height in pixels,
+  quality : JPEG/WebP/AVIF quality to re-encode with (1-95)
+
+  Returns
+  -------
+  (rendition as bytes, content type). An image that already
+  fits, or that there's no encoder for here, is returned as is
+  """
+  image_format = imagecodec.sniff_format(data)
+
+  if image_format is None:
+    raise Exception("results are not an image")
+
+  (pillow_format, options) = save_options[image_format]
+  content_type = imagecodec.formats[image_format][1]
+
+  if image_format == "avif":
+    imagecodec.load_avif_plugin()
+
+  Image.init()
+
+  image = Image.open(io.BytesIO(data))
+
+  if max(image.size) <= max_px or pillow_format not in Image.SAVE:
+    return (data, content_type)
+
+  #
+  # let the JPEG decoder do most of the downscaling:
+  #
+  image.draft("RGB", (max_px, max_px))
+
+  if image_format == "jpeg" and image.mode not in ("RGB", "L"):
+    image = image.convert("RGB")
+  elif image.mode == "P":
+    image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+
+  image.thumbnail((max_px, max_px), Image.LANCZOS)
+
+  rendition = io.BytesIO()
+  image.save(rendition, format=pillow_format, quality=quality, **options)
+
+  return (rendition.getvalue(), content_type)
+
+
+###################################################################
+#
+# image_size:
+#
+def image_size(header):
+  """
+  Returns the (width, height) of an image from the first bytes
+  of it, or None if they don't tell
+  """
+  if imagecodec.sniff_format(header) == "avif":
+    imagecodec.load_avif_plugin()
+
+  try:
+    return Image.open(io.BytesIO(header)).size
+  except Exception:
+    return None
+
+
+###################################################################
+#
+# get_rendition:
+#
+# Makes the rendition if it isn't cached yet. The size of the
+# results is first read from their header, so results that are
+# already small enough are never downloaded whole. Two requests
+# racing to make the same rendition both write the same object,
+# which is harmless.
+#
+def get_rendition(s3_client, bucket, results_key, size, max_px, quality):
+  """
+  Returns the key of the rendition of the results, making and
+  caching it in the bucket first if need be, or the key of the
+  results themselves if the rendition wouldn't be smaller
+
+  Parameters
+  ----------
+  s3_client : S3 client,
+  bucket : the output bucket,
+  results_key : key of the results (an image),
+  size : name of the rendition, e.g. "thumb",
+  max_px : maximum width and height of the rendition,
+  quality : quality to re-encode with
+
+  Returns
+  -------
+  key of the rendition, or results_key, in the bucket
+  """
+  key = rendition_key(results_key, size)
+
+  try:
+    s3_client.head_object(Bucket=bucket, Key=key)
+    return key
+  except ClientError as err:
+    if err.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+      raise
+
+  header = s3_client.get_object(Bucket=bucket, Key=results_key, Range="bytes=0-" + str(HEADER_BYTES - 1))['Body'].read()
+
+  dimensions = image_size(header)
+
+  if dimensions is not None and max(dimensions) <= max_px:
+    print("**Results already fit the", size, "rendition, serving them**")
+    return results_key
+
+  print("**Making", size, "rendition of", results_key, "**")
+
+  data = s3_client.get_object(Bucket=bucket, Key=results_key)['Body'].read()
+
+  (rendition, content_type) = render(data, max_px, quality)
+
+  if len(rendition) >= len(data):
+    print("**Rendition is no smaller than the results, serving them**")
+    return results_key
+
+  s3_client.put_object(Bucket=bucket, Key=key, Body=rendition, ContentType=content_type)
+
+  print("rendition:", len(data), "->", len(rendition), "bytes")
+
+  return key
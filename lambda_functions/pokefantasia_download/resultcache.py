@@ -0,0 +1,157 @@
+#
+# resultcache.py
+#
+# In-memory LRU cache kept at module scope, so it lives as long
+# as the lambda's execution environment and is shared by the
+# requests it serves. Bounded by the total (approximate) size
+# of the cached values; the least recently used are evicted
+# first. Entries also expire after a while.
+#
+# Only immutable things belong in it: rows of completed jobs,
+# and results objects, which are never rewritten. Jobids are
+# reused after a reset of the database, so callers key cached
+# rows by the latest reset as well as by jobid.
+#
+
+import json
+import threading
+import time
+
+from collections import OrderedDict
+
+
+###################################################################
+#
+# approx_size:
+#
+# Rough number of bytes a value takes, counting the contents of
+# strings and bytes and a fixed overhead for everything else.
+#
+def approx_size(value):
+  """
+  Returns the approximate size of a value in bytes
+  """
+  if isinstance(value, (bytes, bytearray, str)):
+    return 64 + len(value)
+  if isinstance(value, (tuple, list)):
+    return 64 + sum(approx_size(v) for v in value)
+  if isinstance(value, dict):
+    return 64 + sum(approx_size(k) + approx_size(v) for (k, v) in value.items())
+  return 32
+
+
+###################################################################
+#
+# LRUCache:
+#
+# Safe to use from several threads at once, e.g. the jobs of a
+# batch download.
+#
+class LRUCache:
+  """
+  Size-bounded LRU cache with expiry
+  """
+
+  def __init__(self, max_bytes, max_item_bytes, ttl_secs):
+    """
+    Parameters
+    ----------
+    max_bytes : total size of the values to keep,
+    max_item_bytes : values bigger than this are never cached,
+    ttl_secs : seconds an entry is kept for
+    """
+    self.max_bytes = max_bytes
+    self.max_item_bytes = max_item_bytes
+    self.ttl_secs = ttl_secs
+
+    self.entries = OrderedDict()  # key -> (value, size, expires)
+    self.bytes = 0
+    self.lock = threading.Lock()
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, key):
+    """
+    Returns the cached value, or None if there is none
+    """
+    with self.lock:
+      entry = self.entries.get(key)
+
+      if entry is not None and entry[2] < time.time():
+        self.remove(key)
+        entry = None
+
+      if entry is None:
+        self.misses += 1
+        return None
+
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return entry[0]
+
+  def put(self, key, value, size=None):
+    """
+    Caches the value, unless it's too big; evicts the least
+    recently used entries to make room
+    """
+    if size is None:
+      size = approx_size(value)
+
+    if size > self.max_item_bytes:
+      return
+
+    with self.lock:
+      if key in self.entries:
+        self.remove(key)
+
+      self.entries[key] = (value, size, time.time() + self.ttl_secs)
+      self.bytes += size
+
+      while self.bytes > self.max_bytes:
+        (oldest, entry) = self.entries.popitem(last=False)
+        self.bytes -= entry[1]
+        self.evictions += 1
+
+  def remove(self, key):
+    """
+    Drops an entry; the caller holds the lock
+    """
+    entry = self.entries.pop(key)
+    self.bytes -= entry[1]
+
+  def emit_metrics(self, namespace, function_name):
+    """
+    Prints the hits, misses and evictions since the last call,
+    and the current size of the cache, in CloudWatch embedded
+    metric format, so they are turned into metrics from the
+    log. The counters are then reset.
+    """
+    with self.lock:
+      (hits, misses, evictions) = (self.hits, self.misses, self.evictions)
+      self.hits = self.misses = self.evictions = 0
+      (entries, bytes) = (len(self.entries), self.bytes)
+
+    print(json.dumps({
+      "_aws": {
+        "Timestamp": int(time.time() * 1000),
+        "CloudWatchMetrics": [{
+          "Namespace": namespace,
+          "Dimensions": [["FunctionName"]],
+          "Metrics": [
+            {"Name": "CacheHits", "Unit": "Count"},
+            {"Name": "CacheMisses", "Unit": "Count"},
+            {"Name": "CacheEvictions", "Unit": "Count"},
+            {"Name": "CacheEntries", "Unit": "Count"},
+            {"Name": "CacheBytes", "Unit": "Bytes"}
+          ]
+        }]
+      },
+      "FunctionName": function_name,
+      "CacheHits": hits,
+      "CacheMisses": misses,
+      "CacheEvictions": evictions,
+      "CacheEntries": entries,
+      "CacheBytes": bytes
+    }))
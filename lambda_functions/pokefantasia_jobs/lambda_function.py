@@ -1,15 +1,156 @@
 #
-# Retrieves and returns all the jobs in the 
-# Pokefantasia database.
+# Retrieves and returns the jobs in the Pokefantasia
+# database, a page at a time in jobid order. Each page ends
+# with the cursor of the next page (the last jobid returned,
+# or None after the last page), so a page costs the same
+# however big the table grows. Jobs can be filtered by userid,
+# status and action.
+#
+# With since=<watermark>, returns instead the jobs that changed
+# (were created, or changed status) after the watermark, and
+# the watermark to poll with next (see changes_since).
+#
+# With export=ndjson or export=gzip, exports all the jobs
+# (filtered the same way) to an S3 object instead, and returns
+# a presigned link to it (see rowexport).
 #
 
 import json
 import boto3
 import os
+import uuid
 import datatier
+import rowexport
 
 from configparser import ConfigParser
 
+
+#
+# the columns returned of each job
+#
+columns = ["jobid", "userid", "status", "originaldatafile", "datafilekey", "resultsfilekey", "bucket"]
+
+
+def get_parameter(event, name, default):
+  """
+  Returns the named parameter from the event, the URL path
+  ("pathParameters") or the query string, or default if absent
+  """
+  if name in event:
+    return event[name]
+  for params in ("pathParameters", "queryStringParameters"):
+    if event.get(params) and name in event[params]:
+      return event[params][name]
+  return default
+
+
+def changes_since(dbConn, since, conditions, parameters, limit, settle_secs):
+  """
+  Returns the jobs changed after the watermark since, oldest
+  change first, at most limit of them, along with the watermark
+  to ask from next time.
+
+  A watermark is "<updatedat>,<jobid>" of the last change
+  returned, so changes with the same updatedat are never split
+  or repeated across calls; "" (or "0") starts from the
+  beginning. Changes younger than settle_secs are left for the
+  next call: a transaction that started earlier may still be
+  about to commit a change with an older updatedat.
+
+  Parameters
+  ----------
+  dbConn : the database connection,
+  since : the watermark,
+  conditions, parameters : the filters, as SQL conditions and
+    their parameters,
+  limit : maximum number of changes,
+  settle_secs : how old a change must be to be returned
+
+  Returns
+  -------
+  dict with jobs (list of dicts, with updatedat), watermark,
+  and more (True if there are more changes already)
+  """
+  if since in ("", "0"):
+    (since_at, since_jobid) = ("1970-01-01 00:00:00", 0)
+  else:
+    (since_at, since_jobid) = since.rsplit(",", 1)
+    since_jobid = int(since_jobid)
+
+  #
+  # the (updatedat, jobid) index makes this a range scan that
+  # starts right after the watermark:
+  #
+  sql = "SELECT " + ", ".join(columns) + ", updatedat FROM jobs"
+  sql += " WHERE (updatedat > %s OR (updatedat = %s AND jobid > %s))"
+  sql += " AND updatedat < NOW(6) - INTERVAL %s MICROSECOND"
+  sql += "".join(" AND " + condition for condition in conditions)
+  sql += " ORDER BY updatedat, jobid LIMIT %s;"
+
+  rows = datatier.retrieve_all_rows(dbConn, sql,
+                                    [since_at, since_at, since_jobid, int(settle_secs * 1000000)] + parameters + [limit + 1])
+
+  more = len(rows) > limit
+  rows = rows[0:limit]
+
+  jobs = []
+  for row in rows:
+    job = dict(zip(columns, row))
+    job['updatedat'] = row[-1].isoformat(sep=" ")
+    jobs.append(job)
+
+  if len(jobs) > 0:
+    since = jobs[-1]['updatedat'] + "," + str(jobs[-1]['jobid'])
+
+  return {
+    'jobs': jobs,
+    'watermark': since,
+    'more': more
+  }
+
+
+def export_jobs(configur, dbConn, export, conditions, parameters):
+  """
+  Exports the jobs matching the filters, in jobid order, to an
+  NDJSON object (gzipped if export is "gzip") in the S3 bucket,
+  reading them through an unbuffered cursor.
+
+  Returns
+  -------
+  dict with a presigned url to the export, its key, the number
+  of rows, and the lifetime of the url
+  """
+  boto3.setup_default_session(profile_name='s3readwrite')
+  s3_client = boto3.client('s3')
+
+  bucket = configur.get('s3', 'bucket_name')
+  key = "exports/jobs-" + str(uuid.uuid4()) + (".ndjson.gz" if export == "gzip" else ".ndjson")
+
+  expires_secs = configur.getint('export', 'presigned_expires_secs', fallback=3600)
+  part_size = configur.getint('export', 'part_size', fallback=8 * 1024 * 1024)
+
+  sql = "SELECT " + ", ".join(columns) + ", updatedat FROM jobs"
+  sql += "".join((" WHERE " if i == 0 else " AND ") + condition for (i, condition) in enumerate(conditions))
+  sql += " ORDER BY jobid;"
+
+  print("**Exporting to", key, "**")
+
+  count = rowexport.export_rows(s3_client, bucket, key, columns + ["updatedat"],
+                                datatier.stream_rows(dbConn, sql, parameters),
+                                export == "gzip", part_size)
+
+  url = s3_client.generate_presigned_url('get_object',
+                                         Params={'Bucket': bucket, 'Key': key},
+                                         ExpiresIn=expires_secs)
+
+  return {
+    'url': url,
+    'key': key,
+    'rows': count,
+    'expires_in': expires_secs
+  }
+
+
 def lambda_handler(event, context):
   try:
     print("**STARTING**")
@@ -33,6 +174,50 @@ def lambda_handler(event, context):
     rds_pwd = configur.get('rds', 'user_pwd')
     rds_dbname = configur.get('rds', 'db_name')
 
+    #
+    # the page: jobs after the cursor (a jobid, 0 for the first
+    # page), at most limit of them. Or with since, the change
+    # feed: jobs changed after the watermark:
+    #
+    default_limit = configur.getint('jobs', 'default_limit', fallback=100)
+    max_limit = configur.getint('jobs', 'max_limit', fallback=1000)
+
+    cursor = int(get_parameter(event, "cursor", 0))
+    since = get_parameter(event, "since", None)
+    export = get_parameter(event, "export", None)
+    limit = int(get_parameter(event, "limit", default_limit))
+
+    if export not in (None, "ndjson", "gzip"):
+      raise Exception("export must be ndjson or gzip")
+
+    if limit < 1 or limit > max_limit:
+      raise Exception("limit must be between 1 and " + str(max_limit))
+
+    #
+    # and the filters, each backed by an index (see
+    # database_creation.sql):
+    #
+    conditions = []
+    parameters = []
+
+    userid = get_parameter(event, "userid", None)
+    status = get_parameter(event, "status", None)
+    action = get_parameter(event, "action", None)
+
+    if userid is not None:
+      conditions.append("userid = %s")
+      parameters.append(int(userid))
+    if status is not None:
+      conditions.append("status = %s")
+      parameters.append(status)
+    if action is not None:
+      if action not in ("typeid", "typecov", "formatcov"):
+        raise Exception("action must be typeid, typecov or formatcov")
+      conditions.append("bucket = %s")
+      parameters.append("bucket_" + action)
+
+    print("cursor:", cursor, "since:", since, "export:", export, "limit:", limit, "userid:", userid, "status:", status, "action:", action)
+
     #
     # open connection to the database:
     #
@@ -40,17 +225,48 @@ def lambda_handler(event, context):
     
     dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
     
+    if export is not None:
+      body = export_jobs(configur, dbConn, export, conditions, parameters)
+
+      print("**DONE, exported", body['rows'], "jobs**")
+
+      return {
+        'statusCode': 200,
+        'body': json.dumps(body)
+      }
+
+    if since is not None:
+      settle_secs = configur.getfloat('jobs', 'settle_secs', fallback=2)
+
+      body = changes_since(dbConn, since, conditions, parameters, limit, settle_secs)
+
+      print("**DONE, returning", len(body['jobs']), "changes**")
+
+      return {
+        'statusCode': 200,
+        'body': json.dumps(body)
+      }
+
     #
-    # now retrieve all the jobs:
+    # now retrieve the page of jobs, plus one more to know if
+    # there's a next page:
     #
     print("**Retrieving data**")
     
-    sql = "SELECT * FROM jobs ORDER BY jobid";
+    sql = "SELECT " + ", ".join(columns) + " FROM jobs WHERE " + " AND ".join(["jobid > %s"] + conditions)
+    sql += " ORDER BY jobid LIMIT %s;"
     
-    rows = datatier.retrieve_all_rows(dbConn, sql)
+    rows = datatier.retrieve_all_rows(dbConn, sql, [cursor] + parameters + [limit + 1])
     
-    for row in rows:
-      print(row)
+    print(len(rows), "rows")
+
+    next_cursor = None
+
+    if len(rows) > limit:
+      rows = rows[0:limit]
+      next_cursor = rows[-1][0]
+
+    jobs = [dict(zip(columns, row)) for row in rows]
 
     #
     # respond in an HTTP-like way, i.e. with a status
@@ -60,7 +276,10 @@ def lambda_handler(event, context):
     
     return {
       'statusCode': 200,
-      'body': json.dumps(rows)
+      'body': json.dumps({
+        'jobs': jobs,
+        'next_cursor': next_cursor
+      })
     }
     
   except Exception as err:
@@ -49,10 +49,38 @@ def lambda_handler(event, context):
     
     datatier.perform_action(dbConn, sql)
     
+    sql = "TRUNCATE TABLE jobtimings";
+    
+    datatier.perform_action(dbConn, sql)
+    
+    sql = "TRUNCATE TABLE jobtargets";
+    
+    datatier.perform_action(dbConn, sql)
+    
     sql = "TRUNCATE TABLE jobs";
     
     datatier.perform_action(dbConn, sql)
     
+    #
+    # TRUNCATE doesn't fire the triggers that maintain the job
+    # summary tables, so they're emptied too:
+    #
+    sql = "TRUNCATE TABLE jobcounts";
+    
+    datatier.perform_action(dbConn, sql)
+    
+    sql = "TRUNCATE TABLE jobtotals";
+    
+    datatier.perform_action(dbConn, sql)
+    
+    sql = "TRUNCATE TABLE jobhours";
+    
+    datatier.perform_action(dbConn, sql)
+    
+    sql = "TRUNCATE TABLE dedupcounts";
+    
+    datatier.perform_action(dbConn, sql)
+    
     print("**Deleting users**")
     
     sql = "TRUNCATE TABLE users";
@@ -71,6 +99,14 @@ def lambda_handler(event, context):
     
     datatier.perform_action(dbConn, sql)
     
+    #
+    # jobids start over, so record the reset; caches of job
+    # rows (see the download lambda) are keyed by the latest:
+    #
+    sql = "INSERT INTO resets(resetat) values(NOW());"
+    
+    datatier.perform_action(dbConn, sql)
+    
     print("**Inserting 3 users back into database...")
     
     sql = """
@@ -0,0 +1,356 @@
+#
+# datatier.py
+#
+# Executes SQL queries against a MySQL database, over a
+# connection kept open across warm invocations (see get_dbConn).
+#
+# Original author:
+#   Prof. Joe Hummel
+#   Northwestern University
+#
+
+import json
+import os
+import time
+import pymysql
+
+from pymysql.constants import SERVER_STATUS
+
+
+#
+# The connection is kept open at module scope, so the
+# invocations of a warm lambda container share it instead of
+# each paying for a new connection (TCP, TLS, login). These
+# record what it was opened with, when, and how many times it
+# had to be opened again because it had gone stale.
+#
+shared_dbConn = None
+shared_params = None
+opened_at = 0.0
+reconnects = 0
+
+#
+# session settings put back to their defaults before the
+# connection is reused, in case the last user changed them
+# (e.g. pokefantasia_reset turns off foreign key checks)
+#
+reset_sql = "SET SESSION foreign_key_checks = DEFAULT, unique_checks = DEFAULT;"
+
+
+###################################################################
+#
+# get_dbConn:
+#
+# Returns a connection object for interacting with a MySQL
+# database: the connection kept from an earlier call if it's
+# for the same database and still alive (checked with a ping),
+# otherwise a newly opened one. A reused connection has any
+# transaction left open rolled back and its session settings
+# reset, so it behaves like a new one.
+#
+def get_dbConn(endpoint, portnum, username, pwd, dbname):
+  """
+  Returns a connection object for interacting with a MySQL
+  database, reusing the kept connection when possible
+
+  Parameters
+  ----------
+  endpoint : machine name or IP address of server (string),
+  portnum : server port # (integer),
+  username : user name for login (string),
+  pwd : user password for login (string),
+  dbname : database name (string)
+
+  Returns
+  -------
+  a connection object
+  """
+  global shared_dbConn, shared_params, opened_at, reconnects
+
+  params = (endpoint, portnum, username, pwd, dbname)
+  reconnected = False
+
+  try:
+    if shared_dbConn is not None and shared_params == params:
+      try:
+        shared_dbConn.ping(reconnect=False)
+
+        if shared_dbConn.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+          shared_dbConn.rollback()
+
+        dbCursor = shared_dbConn.cursor()
+        try:
+          dbCursor.execute(reset_sql)
+        finally:
+          dbCursor.close()
+
+        emit_metrics(True, False)
+        return shared_dbConn
+
+      except Exception as err:
+        print("datatier.get_dbConn(): kept connection is stale, reconnecting:", str(err))
+        reconnects += 1
+        reconnected = True
+
+    if shared_dbConn is not None:
+      try:
+        shared_dbConn.close()
+      except Exception:
+        pass  # already closed or broken
+
+      shared_dbConn = None
+
+    dbConn = pymysql.connect(host=endpoint,
+                             port=portnum,
+                             user=username,
+                             passwd=pwd,
+                             database=dbname)
+
+    shared_dbConn = dbConn
+    shared_params = params
+    opened_at = time.time()
+
+    emit_metrics(False, reconnected)
+    return dbConn
+
+  except Exception as err:
+    print("datatier.get_dbConn() failed:")
+    print(str(err))
+    raise
+
+
+###################################################################
+#
+# get_metrics / emit_metrics:
+#
+# The age of the kept connection and the number of reconnects
+# in this container. Every get_dbConn prints the age, and
+# whether it reused the connection or had to reconnect, in
+# CloudWatch embedded metric format so they are turned into
+# metrics from the log.
+#
+def get_metrics():
+  """
+  Returns the connection metrics as a dict: age_secs of the kept
+  connection (0 if none) and reconnects so far
+  """
+  return {
+    'age_secs': time.time() - opened_at if shared_dbConn is not None else 0.0,
+    'reconnects': reconnects
+  }
+
+
+def emit_metrics(reused, reconnected):
+  """
+  Prints the age of the connection, whether it was reused, and
+  whether a stale one was replaced, in CloudWatch embedded
+  metric format
+  """
+  metrics = get_metrics()
+
+  print(json.dumps({
+    "_aws": {
+      "Timestamp": int(time.time() * 1000),
+      "CloudWatchMetrics": [{
+        "Namespace": "Pokefantasia",
+        "Dimensions": [["FunctionName"]],
+        "Metrics": [
+          {"Name": "DBConnectionAge", "Unit": "Seconds"},
+          {"Name": "DBReconnect", "Unit": "Count"},
+          {"Name": "DBConnectionReused", "Unit": "Count"}
+        ]
+      }]
+    },
+    "FunctionName": os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "unknown"),
+    "DBConnectionAge": round(metrics['age_secs'], 3),
+    "DBReconnect": 1 if reconnected else 0,
+    "DBConnectionReused": 1 if reused else 0
+  }))
+
+
+##################################################################
+#
+# retrieve_one_row:
+#
+# Given a database connection and an SQL Select query,
+# executes this query against the database and returns
+# the first row (tuple) retrieved by the query (the tuple
+# can be empty if the SELECT retrieved no data). The query
+# can be parameterized using %s, in which case pass the
+# values as a list [value1, value2, ...]
+#
+def retrieve_one_row(dbConn, sql, parameters=[]):
+  """
+  Executes an sql SELECT query against the database connection
+  and returns the first row as a tuple
+
+  Parameters
+  __________
+  dbConn : the database connection, 
+  sql : the SQL SELECT query (can be parameterized with %s),
+  parameters: optional list of values if parameterized
+
+  Returns
+  _______
+  First row as a tuple, or () if SELECT retrieves no data
+  """
+
+  dbCursor = dbConn.cursor()
+
+  try:
+    dbCursor.execute(sql, parameters)
+    row = dbCursor.fetchone()
+    if row is None:  # executed successfully, but no data was retrieved
+      return ()
+    else:
+      return row
+
+  except Exception as err:
+    print("datatier.retrieve_one_row() failed:")
+    print(str(err))
+    raise
+
+  finally:
+    dbCursor.close()
+
+
+##################################################################
+#
+# retrieve_all_rows:
+#
+# Given a database connection and an SQL Select query,
+# executes this query against the database and returns
+# a list of rows (tuples) retrieved by the query. If the
+# query retrieves no data, the empty list [] is returned.
+# The query can be parameterized using %s, in which case
+# pass the values as a list [value1, value2, ...]
+#
+def retrieve_all_rows(dbConn, sql, parameters=[]):
+  """
+  Executes an sql SELECT query against the database connection
+  and returns all rows as a list of tuples
+
+  Parameters
+  __________
+  dbConn : the database connection, 
+  sql : the SQL SELECT query (can be parameterized with %s),
+  parameters: optional list of values if parameterized
+
+  Returns
+  _______
+  All rows as a list of tuples, or [] if SELECT retrieves no
+  data
+  """
+
+  dbCursor = dbConn.cursor()
+
+  try:
+    dbCursor.execute(sql, parameters)
+    rows = dbCursor.fetchall()
+    if rows is None:  # executed successfully, but no data was retrieved
+      return []
+    else:
+      return rows
+
+  except Exception as err:
+    print("datatier.retrieve_all_rows() failed:")
+    print(str(err))
+    raise
+
+  finally:
+    dbCursor.close()
+
+
+##################################################################
+#
+# stream_rows:
+#
+# Given a database connection and an SQL Select query,
+# executes this query against the database and yields the
+# rows (tuples) one at a time as they arrive from the server,
+# through an unbuffered cursor, so memory use doesn't grow
+# with the number of rows. The connection can't be used for
+# anything else until all the rows have been read (or the
+# generator is closed). The query can be parameterized using
+# %s, in which case pass the values as a list
+# [value1, value2, ...]
+#
+def stream_rows(dbConn, sql, parameters=[]):
+  """
+  Executes an sql SELECT query against the database connection
+  and yields the rows one at a time as tuples
+
+  Parameters
+  __________
+  dbConn : the database connection, 
+  sql : the SQL SELECT query (can be parameterized with %s),
+  parameters: optional list of values if parameterized
+
+  Yields
+  ______
+  Each row as a tuple
+  """
+
+  dbCursor = dbConn.cursor(pymysql.cursors.SSCursor)
+
+  try:
+    dbCursor.execute(sql, parameters)
+    for row in dbCursor:
+      yield row
+
+  except Exception as err:
+    print("datatier.stream_rows() failed:")
+    print(str(err))
+    raise
+
+  finally:
+    dbCursor.close()
+
+
+###############################################################
+#
+# perform_action:
+#
+# Given a database connection and an SQL action query,
+# executes an ACTION query and returns the number of rows
+# modified; a return value of 0 means no rows were
+# modified. Action queries are typically "insert",
+# "update", "delete". The query can be parameterized
+# using %s, in which case pass the values as a list
+# [value1, value2, ...]
+#
+def perform_action(dbConn, sql, parameters=[]):
+  """
+  Executes an sql ACTION query against the database connection
+  and returns number of rows modified
+
+  Parameters
+  __________
+  dbConn : the database connection, 
+  sql : the SQL SELECT query (can be parameterized with %s),
+  parameters: optional list of values if parameterized
+
+  Returns
+  _______
+  number of rows modified (0 is not an error but implies
+  the query made no modifications)
+  """
+
+  dbCursor = dbConn.cursor()
+
+  try:
+    # try to execute, and if successful commit the changes
+    # and return the # of rows modified by the query:
+    dbCursor.execute(sql, parameters)
+    dbConn.commit()
+    return dbCursor.rowcount
+
+  except Exception as err:
+    # failed, rollback any possible changes and log error:
+    dbConn.rollback()
+    print("datatier.perform_action() failed:")
+    print(str(err))
+    raise
+
+  finally:
+    dbCursor.close()
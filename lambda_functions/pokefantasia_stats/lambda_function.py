@@ -0,0 +1,247 @@
+#
+# Computes reports over the Pokefantasia database. The
+# timings report gives the p50/p95/p99 latency of each stage
+# of typecov jobs over a time window; the dedup report gives
+# the share of uploads that reused earlier results, over all
+# jobs; the jobs report gives the number of jobs in each status
+# per action (optionally of one user), and per hour over a time
+# window, from the summary tables the database keeps up to date
+# (see database_creation.sql), so it costs the same however
+# many jobs there are.
+#
+
+import json
+import boto3
+import os
+import math
+import time
+import datatier
+
+from configparser import ConfigParser
+
+
+def percentile(sorted_values, p):
+  """
+  Returns the p-th percentile (nearest rank) of a non-empty
+  list of values sorted in ascending order
+  """
+  rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+  return sorted_values[rank - 1]
+
+
+def get_parameter(event, name, default):
+  """
+  Returns the named parameter from the event, the URL path
+  ("pathParameters") or the query string, or default if absent
+  """
+  if name in event:
+    return event[name]
+  for params in ("pathParameters", "queryStringParameters"):
+    if event.get(params) and name in event[params]:
+      return event[params][name]
+  return default
+
+
+def timings_report(dbConn, hours):
+  """
+  Computes the p50/p95/p99 duration of each stage over the
+  stages started in the last given hours.
+
+  Returns
+  -------
+  dict of stage -> {count, p50, p95, p99, max} in milliseconds
+  """
+  since = time.time() - hours * 3600
+
+  sql = """
+    SELECT stage, durationms FROM jobtimings
+     WHERE startedat >= %s
+     ORDER BY stage, durationms;
+  """
+
+  rows = datatier.retrieve_all_rows(dbConn, sql, [since])
+
+  durations = {}
+  for (stage, durationms) in rows:
+    durations.setdefault(stage, []).append(durationms)
+
+  report = {}
+  for (stage, values) in durations.items():
+    report[stage] = {
+      'count': len(values),
+      'p50': percentile(values, 50),
+      'p95': percentile(values, 95),
+      'p99': percentile(values, 99),
+      'max': values[-1]
+    }
+
+  return report
+
+
+def dedup_report(dbConn):
+  """
+  Computes the dedup hit rate of each action: of the uploads
+  that were hashed (i.e. not presigned), how many reused the
+  results of an earlier identical upload. The counts are kept
+  by a trigger on jobs (see database_creation.sql), so this
+  reads one row per action.
+
+  Returns
+  -------
+  dict of bucket -> {uploads, hits, hit_rate}
+  """
+  sql = "SELECT bucket, uploads, hits FROM dedupcounts ORDER BY bucket;"
+
+  rows = datatier.retrieve_all_rows(dbConn, sql)
+
+  report = {}
+  for (bucket, uploads, hits) in rows:
+    report[bucket] = {
+      'uploads': uploads,
+      'hits': int(hits),
+      'hit_rate': int(hits) / uploads
+    }
+
+  return report
+
+
+def jobs_report(dbConn, hours, userid=None):
+  """
+  Reports the jobs currently in each status, per action and
+  overall (of one user if given), and the jobs created and
+  entering each status per hour over the last given hours, with
+  the error rate of each action over those hours.
+
+  Returns
+  -------
+  dict with current (action -> status -> jobs), by_status
+  (status -> jobs), hourly (hour -> action -> status -> jobs)
+  and window (action -> {created, completed, error, error_rate})
+  """
+  #
+  # overall counts come straight from jobtotals, one row per
+  # action and status, however many users there are:
+  #
+  if userid is None:
+    sql = "SELECT bucket, status, jobs FROM jobtotals ORDER BY bucket, status;"
+    parameters = []
+  else:
+    sql = "SELECT bucket, status, jobs FROM jobcounts WHERE userid = %s ORDER BY bucket, status;"
+    parameters = [userid]
+
+  rows = datatier.retrieve_all_rows(dbConn, sql, parameters)
+
+  current = {}
+  by_status = {}
+  for (bucket, status, jobs) in rows:
+    jobs = int(jobs)
+    if jobs == 0:
+      continue
+    action = bucket[len("bucket_"):]
+    current.setdefault(action, {})[status] = jobs
+    by_status[status] = by_status.get(status, 0) + jobs
+
+  sql = """
+    SELECT hour, bucket, status, jobs FROM jobhours
+     WHERE hour >= DATE_FORMAT(NOW() - INTERVAL %s HOUR, '%%Y-%%m-%%d %%H:00:00')
+     ORDER BY hour, bucket, status;
+  """
+
+  rows = datatier.retrieve_all_rows(dbConn, sql, [math.ceil(hours)])
+
+  hourly = {}
+  window = {}
+  for (hour, bucket, status, jobs) in rows:
+    action = bucket[len("bucket_"):]
+    hourly.setdefault(str(hour), {}).setdefault(action, {})[status] = jobs
+    totals = window.setdefault(action, {'created': 0, 'completed': 0, 'error': 0})
+    if status in totals:
+      totals[status] += jobs
+
+  for totals in window.values():
+    finished = totals['completed'] + totals['error']
+    totals['error_rate'] = totals['error'] / finished if finished > 0 else None
+
+  return {
+    'current': current,
+    'by_status': by_status,
+    'hourly': hourly,
+    'window': window
+  }
+
+
+def lambda_handler(event, context):
+  try:
+    print("**STARTING**")
+    print("**lambda: pokefantasia_stats**")
+
+    #
+    # setup AWS based on config file:
+    #
+    config_file = 'pokefantasia-config.ini'
+    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
+
+    configur = ConfigParser()
+    configur.read(config_file)
+
+    #
+    # configure for RDS access
+    #
+    rds_endpoint = configur.get('rds', 'endpoint')
+    rds_portnum = int(configur.get('rds', 'port_number'))
+    rds_username = configur.get('rds', 'user_name')
+    rds_pwd = configur.get('rds', 'user_pwd')
+    rds_dbname = configur.get('rds', 'db_name')
+
+    #
+    # which report, and over what window:
+    #
+    report = get_parameter(event, "report", "timings")
+    hours = float(get_parameter(event, "hours", 24))
+    userid = get_parameter(event, "userid", None)
+
+    print("report:", report)
+    print("hours:", hours)
+
+    #
+    # open connection to the database:
+    #
+    print("**Opening connection**")
+
+    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+
+    if report == "timings":
+      print("**Computing stage timings**")
+      result = timings_report(dbConn, hours)
+    elif report == "dedup":
+      print("**Computing dedup hit rate**")
+      result = dedup_report(dbConn)
+    elif report == "jobs":
+      print("**Reading job summary**")
+      result = jobs_report(dbConn, hours, int(userid) if userid is not None else None)
+    else:
+      raise Exception("unknown report: " + str(report))
+
+    #
+    # respond in an HTTP-like way, i.e. with a status
+    # code and body in JSON format:
+    #
+    print("**DONE, returning report**")
+
+    return {
+      'statusCode': 200,
+      'body': json.dumps({
+        'report': report,
+        'hours': hours,
+        'result': result
+      })
+    }
+
+  except Exception as err:
+    print("**ERROR**")
+    print(str(err))
+
+    return {
+      'statusCode': 500,
+      'body': json.dumps(str(err))
+    }
@@ -0,0 +1,89 @@
+#
+# bodydecoder.py
+#
+# Decodes upload request bodies: the JSON body is parsed once,
+# and the base64 image data is decoded incrementally into an
+# in-memory buffer that can be handed to S3 upload_fileobj,
+# without a decoded copy of the whole image in between or a
+# file in /tmp.
+#
+
+import base64
+import binascii
+import io
+import json
+
+
+#
+# base64 characters decoded per step; a multiple of 4 so every
+# step decodes whole 3-byte groups
+#
+CHUNK_CHARS = 4 * 256 * 1024
+
+
+###################################################################
+#
+# parse_body:
+#
+# Parses the JSON body of the event, once. API Gateway may
+# deliver the body itself base64-encoded (isBase64Encoded).
+#
+def parse_body(event):
+  """
+  Parses the JSON request body of the event
+
+  Parameters
+  ----------
+  event : the lambda event
+
+  Returns
+  -------
+  the body as a dict
+  """
+  if "body" not in event:
+    raise Exception("event has no body")
+
+  body = event["body"]
+
+  if event.get("isBase64Encoded", False):
+    body = base64.b64decode(body)
+
+  return json.loads(body)
+
+
+###################################################################
+#
+# decode_base64:
+#
+# Decodes base64 data into a BytesIO buffer, CHUNK_CHARS at a
+# time, so the peak extra memory is the decoded image plus one
+# chunk.
+#
+def decode_base64(datastr):
+  """
+  Decodes a base64 string incrementally into a buffer
+
+  Parameters
+  ----------
+  datastr : base64-encoded data (string)
+
+  Returns
+  -------
+  io.BytesIO positioned at the start of the decoded data
+  """
+  buffer = io.BytesIO()
+
+  try:
+    for start in range(0, len(datastr), CHUNK_CHARS):
+      chunk = base64.b64decode(datastr[start:start + CHUNK_CHARS], validate=True)
+      buffer.write(chunk)
+
+  except binascii.Error:
+    #
+    # not plain base64 (e.g. has line breaks), so chunks
+    # don't line up; decode the whole string leniently:
+    #
+    buffer = io.BytesIO(base64.b64decode(datastr))
+
+  buffer.seek(0)
+  return buffer
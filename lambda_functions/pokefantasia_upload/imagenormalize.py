@@ -0,0 +1,348 @@
+#
+# imagenormalize.py
+#
+# Normalizes an uploaded image before it goes to S3, so the
+# compute lambdas get no more bytes than their action needs:
+# the EXIF orientation is applied, metadata (EXIF, XMP, IPTC,
+# comments) is dropped, the image is downscaled to fit the
+# action's maximum size, and it's re-encoded in its own format
+# (see imagecodec). An image that needs neither rotating nor
+# downscaling is never re-encoded: its metadata is cut out of
+# the file, losslessly. The ICC color profile is kept either
+# way, so wide-gamut (e.g. Display P3) photos keep their colors.
+#
+# Needs Pillow in the upload lambda (e.g. as a layer); see
+# [normalize] in the config file.
+#
+
+import io
+import struct
+import imagecodec
+
+from PIL import Image, ImageOps
+
+
+#
+# EXIF tag holding the orientation
+#
+ORIENTATION = 0x0112
+
+#
+# JPEG segments holding metadata: APP1 (EXIF, XMP), APP2 (MPF;
+# APP2 segments holding the ICC profile are kept), APP13 (IPTC)
+# and COM
+#
+JPEG_METADATA_MARKERS = (0xE1, 0xE2, 0xED, 0xFE)
+
+JPEG_ICC_SIGNATURE = b"ICC_PROFILE\x00"
+
+#
+# PNG chunks holding metadata (iCCP, the ICC profile, is kept)
+#
+PNG_METADATA_CHUNKS = (b"eXIf", b"tEXt", b"zTXt", b"iTXt", b"tIME")
+
+#
+# WebP chunks holding metadata, and their flags in the VP8X
+# header: EXIF 0x08, XMP 0x04 (ICCP, the ICC profile, is kept)
+#
+WEBP_METADATA_CHUNKS = {b"EXIF": 0x08, b"XMP ": 0x04}
+
+#
+# imagecodec format -> Pillow format and encoder options
+#
+save_options = {
+  "jpeg": ("JPEG", {"optimize": True}),
+  "png": ("PNG", {"optimize": True}),
+  "webp": ("WEBP", {"method": 4}),
+  "avif": ("AVIF", {})
+}
+
+
+###################################################################
+#
+# strip_metadata:
+#
+# Cuts the metadata out of a JPEG, PNG or WebP file, copying the
+# image data itself unchanged, so nothing is lost. AVIF isn't
+# supported (its metadata is spread through nested ISO-BMFF
+# boxes) and gets None.
+#
+def strip_metadata(data, image_format):
+  """
+  Returns the image without its metadata
+
+  Parameters
+  ----------
+  data : the image (bytes-like),
+  image_format : format of the image (see imagecodec)
+
+  Returns
+  -------
+  bytes of the image without metadata, or None if the format
+  isn't supported or the file isn't laid out as expected
+  """
+  data = bytes(data)
+
+  try:
+    if image_format == "jpeg":
+      return strip_jpeg(data)
+    if image_format == "png":
+      return strip_png(data)
+    if image_format == "webp":
+      return strip_webp(data)
+  except (IndexError, ValueError, struct.error):
+    pass
+
+  return None
+
+
+def strip_jpeg(data):
+  """
+  Drops the metadata segments before the start of scan; the
+  entropy-coded data after it is copied as is
+  """
+  if data[0:2] != b"\xff\xd8":
+    raise ValueError("not a JPEG")
+
+  out = bytearray(data[0:2])
+  pos = 2
+
+  while True:
+    if data[pos] != 0xFF:
+      raise ValueError("bad JPEG marker")
+
+    marker = data[pos + 1]
+
+    if marker == 0xFF:  # fill byte
+      pos += 1
+      continue
+
+    if marker == 0xDA:  # start of scan: the rest is image data
+      out += data[pos:]
+      return bytes(out)
+
+    if marker == 0x01 or 0xD0 <= marker <= 0xD7:  # no length
+      out += data[pos:pos + 2]
+      pos += 2
+      continue
+
+    length = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+    end = pos + 2 + length
+
+    if end > len(data):
+      raise ValueError("truncated JPEG")
+
+    icc = marker == 0xE2 and data[pos + 4:pos + 4 + len(JPEG_ICC_SIGNATURE)] == JPEG_ICC_SIGNATURE
+
+    if marker not in JPEG_METADATA_MARKERS or icc:
+      out += data[pos:end]
+
+    pos = end
+
+
+def strip_png(data):
+  """
+  Drops the metadata chunks
+  """
+  if data[0:8] != b"\x89PNG\r\n\x1a\n":
+    raise ValueError("not a PNG")
+
+  out = bytearray(data[0:8])
+  pos = 8
+
+  while pos < len(data):
+    length = struct.unpack(">I", data[pos:pos + 4])[0]
+    chunk_type = data[pos + 4:pos + 8]
+    end = pos + 12 + length
+
+    if end > len(data):
+      raise ValueError("truncated PNG")
+
+    if chunk_type not in PNG_METADATA_CHUNKS:
+      out += data[pos:end]
+
+    pos = end
+
+    if chunk_type == b"IEND":
+      break
+
+  return bytes(out)
+
+
+def strip_webp(data):
+  """
+  Drops the metadata chunks of an extended (VP8X) WebP, clears
+  their flags in the VP8X header, and fixes the RIFF size. A
+  simple WebP has no metadata
+  """
+  if data[0:4] != b"RIFF" or data[8:12] != b"WEBP":
+    raise ValueError("not a WebP")
+
+  out = bytearray(data[0:12])
+  pos = 12
+  vp8x = None
+  flags = 0
+
+  while pos + 8 <= len(data):
+    chunk_type = data[pos:pos + 4]
+    length = struct.unpack("<I", data[pos + 4:pos + 8])[0]
+    end = pos + 8 + length + (length & 1)
+
+    if pos + 8 + length > len(data):
+      raise ValueError("truncated WebP")
+
+    if chunk_type in WEBP_METADATA_CHUNKS:
+      flags |= WEBP_METADATA_CHUNKS[chunk_type]
+    else:
+      if chunk_type == b"VP8X":
+        vp8x = len(out) + 8
+      out += data[pos:end]
+
+    pos = end
+
+  if vp8x is not None:
+    out[vp8x] &= ~flags & 0xFF
+
+  out[4:8] = struct.pack("<I", len(out) - 8)
+
+  return bytes(out)
+
+
+def webp_is_lossless(data):
+  """
+  Returns True if the WebP is lossless, i.e. its image is a VP8L
+  chunk rather than VP8
+  """
+  data = bytes(data)
+  pos = 12
+
+  while pos + 8 <= len(data):
+    chunk_type = data[pos:pos + 4]
+    length = struct.unpack("<I", data[pos + 4:pos + 8])[0]
+
+    if chunk_type == b"VP8L":
+      return True
+    if chunk_type == b"VP8 ":
+      return False
+
+    pos += 8 + length + (length & 1)
+
+  return False
+
+
+###################################################################
+#
+# normalize:
+#
+# Returns the normalized image as a new BytesIO. An image that
+# needs neither rotating nor downscaling is returned with its
+# metadata cut out but its pixels untouched (or as is, if that
+# can't be done for the format), since re-encoding would only
+# lose quality. Otherwise the image is re-encoded, losslessly if
+# it was a lossless WebP, and with its ICC profile.
+#
+def normalize(data, image_format, max_px, quality):
+  """
+  Normalizes an image
+
+  Parameters
+  ----------
+  data : BytesIO with the image,
+  image_format : format of the image (see imagecodec),
+  max_px : maximum width and height in pixels, 0 for no limit,
+  quality : JPEG/WebP/AVIF quality to re-encode with (1-95)
+
+  Returns
+  -------
+  BytesIO positioned at the start of the normalized image
+  """
+  (pillow_format, options) = save_options[image_format]
+
+  if image_format == "avif":
+    imagecodec.load_avif_plugin()
+
+  data.seek(0)
+
+  #
+  # opening only reads the header, enough for the size and the
+  # EXIF orientation:
+  #
+  image = Image.open(data)
+  original_size = image.size
+  original_bytes = data.getbuffer().nbytes
+
+  rotated = image.getexif().get(ORIENTATION, 1) != 1
+  resized = max_px > 0 and max(image.size) > max_px
+
+  if not rotated and not resized:
+    stripped = strip_metadata(data.getbuffer(), image_format)
+
+    if stripped is None:
+      data.seek(0)
+      return data
+
+    print("metadata stripped:", original_bytes, "->", len(stripped), "bytes")
+    return io.BytesIO(stripped)
+
+  #
+  # no encoder for this format here, leave the image as is:
+  #
+  Image.init()
+
+  if pillow_format not in Image.SAVE:
+    data.seek(0)
+    return data
+
+  options = dict(options)
+
+  if image_format == "webp" and webp_is_lossless(data.getbuffer()):
+    options["lossless"] = True
+
+  #
+  # the ICC profile describes the colors of the pixels, so it
+  # goes with them; except for a CMYK profile, as the pixels are
+  # converted to RGB below:
+  #
+  if image.info.get("icc_profile") and image.mode != "CMYK":
+    options["icc_profile"] = image.info["icc_profile"]
+
+  #
+  # for a big reduction, let the JPEG decoder downscale by
+  # 1/2, 1/4 or 1/8 as it decodes, which is far cheaper than
+  # decoding at full size (the box is square, so it holds
+  # whatever the orientation):
+  #
+  if resized:
+    image.draft("RGB", (max_px, max_px))
+
+  #
+  # rotate / flip the pixels per the EXIF orientation, since
+  # the orientation tag is about to be dropped:
+  #
+  image = ImageOps.exif_transpose(image)
+
+  #
+  # JPEG has no alpha; the other formats keep it. Palette
+  # images are expanded so they can be resampled smoothly:
+  #
+  if image_format == "jpeg" or image.mode in ("1", "CMYK", "YCbCr", "I", "F"):
+    image = image.convert("RGB" if image.mode != "L" else "L")
+  elif image.mode == "P":
+    image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+
+  #
+  # downscale to fit max_px x max_px, keeping the aspect ratio:
+  #
+  if resized:
+    image.thumbnail((max_px, max_px), Image.LANCZOS)
+
+  #
+  # re-encode without any metadata but the ICC profile:
+  #
+  normalized = io.BytesIO()
+  image.save(normalized, format=pillow_format, quality=quality, **options)
+
+  print("normalized:", original_size, "->", image.size, ",", original_bytes, "->", normalized.getbuffer().nbytes, "bytes")
+
+  normalized.seek(0)
+  return normalized
@@ -1,19 +1,88 @@
 #
-# Uploads a JPEG to S3 and then inserts a new job record
-# in the Pokefantasia database with the status of 'uploaded'.
-# Sends the job id back to the client.
+# Uploads an image (JPEG, PNG, WebP or AVIF) to S3 and then
+# inserts a new job record in the Pokefantasia database with
+# the status of 'uploaded'. Sends the job id back to the
+# client. For a presigned upload the job record is inserted
+# first, and the client gets a presigned POST to upload the
+# image to S3 directly. A batch upload ("files" in the body)
+# does the same for many images at once and sends back the
+# list of job ids. An image that was already processed for the
+# same action and target is not uploaded again: its job is
+# completed right away with the earlier results. Uploaded
+# images can be normalized on the way: EXIF orientation
+# applied, metadata stripped, and downscaled to what the
+# action needs.
+#
+# The username of each user is cached for a while by the
+# container, so the user check usually costs no query.
 #
 
 import json
 import boto3
 import os
+import time
 import uuid
-import base64
+import hashlib
 import pathlib
 import datatier
+import bodydecoder
+import imagecodec
+import pokemontypes
 
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 
+
+#
+# userid -> (username, expiry time) of the users this container
+# has seen. Entries expire after [users] cache_ttl_secs, and a
+# user that turns out to no longer exist is dropped right away
+# (see forget_username)
+#
+usernames = {}
+
+#
+# beyond this many users the cache starts over, to bound memory
+#
+max_cached_users = 10000
+
+
+def lookup_username(dbConn, userid, ttl_secs):
+  """
+  Returns the username of the user, from the cache if it's
+  there and fresh and otherwise from the users table, or None
+  if there's no such user. Only users that exist are cached.
+  """
+  cached = usernames.get(str(userid))
+
+  if cached is not None and cached[1] > time.time():
+    return cached[0]
+
+  sql = "SELECT username FROM users WHERE userid = %s;"
+
+  row = datatier.retrieve_one_row(dbConn, sql, [userid])
+
+  if row == ():
+    forget_username(userid)
+    return None
+
+  if len(usernames) >= max_cached_users:
+    usernames.clear()
+
+  usernames[str(userid)] = (row[0], time.time() + ttl_secs)
+
+  return row[0]
+
+
+def forget_username(userid):
+  """
+  Drops the user from the cache, e.g. once it's known to no
+  longer exist
+  """
+  usernames.pop(str(userid), None)
+
+
 def lambda_handler(event, context):
   try:
     print("**STARTING**")
@@ -86,14 +155,11 @@ def lambda_handler(event, context):
       raise Exception("given invalid action", action)
 
     #
-    # parse request body
-
+    # parse request body, once:
+    #
     print("**Accessing request body**")
 
-    if "body" not in event:
-      raise Exception("event has no body")
-
-    body = json.loads(event["body"])
+    body = bodydecoder.parse_body(event)
 
     #
     # accessing target_type or target_format based on
@@ -102,26 +168,46 @@ def lambda_handler(event, context):
 
     target_type = ""
     target_format = ""
-
-    # parse json
-    body = json.loads(event["body"])
     
     if action == "typecov":
       if "target_type" in event:
         target_type = event["target_type"]
       elif "body" in event:
-        if "target_type" in body:
+        if "target_types" in body:
+          #
+          # multi-type job: a list of types, or "all" for every
+          # type, converted from the same uploaded image:
+          #
+          target_types = body["target_types"]
+          if isinstance(target_types, list):
+            target_type = ",".join(target_types)
+          else:
+            target_type = str(target_types)
+          if target_type == "":
+            raise Exception("requires at least one type in target_types")
+        elif "target_type" in body:
           target_type = body["target_type"]
         else:
           raise Exception("requires target_type in body")
       else:
         raise Exception("requires target_type parameter in event")
+
+    #
+    # a typecov job makes one remote call per type, which is
+    # what it weighs in the typecov backlog; the types are
+    # parsed as typecov parses them (see pokemontypes). Types
+    # are matched in lowercase, so "Fire" and "fire" dedup:
+    #
+    target_count = 1
+
+    if action == "typecov":
+      target_type = target_type.strip().lower()
+      target_count = max(1, len(pokemontypes.parse_target_types(target_type)))
         
     if action == "formatcov":
       if "target_format" in event:
         target_format = event["target_format"]
       elif "body" in event:
-        body = json.loads(event["body"])
         if "target_format" in body:
           target_format = body["target_format"]
         else:
@@ -131,19 +217,36 @@ def lambda_handler(event, context):
       
   
     #
-    # parse filename and data
+    # parse filename and data. With "presigned": true the
+    # body has no data; instead the client gets a presigned
+    # POST and uploads the image directly to S3. A batch
+    # request has a "files" list of {filename, data} instead
+    # of a single filename and data:
+    #
+    presigned = body.get("presigned", False) is True
+    batch = "files" in body
 
-    
-    if "filename" not in body:
-      raise Exception("event has a body but no filename")
-    if "data" not in body:
-      raise Exception("event has a body but no data")
+    if batch:
+      files = body["files"]
+      max_batch_files = configur.getint('upload', 'max_batch_files', fallback=200)
 
-    filename = body["filename"]
-    datastr = body["data"]
-    
-    print("filename:", filename)
-    print("datastr (first 10 chars):", datastr[0:10])
+      if not isinstance(files, list) or len(files) == 0:
+        raise Exception("requires at least one file in files")
+      if len(files) > max_batch_files:
+        raise Exception("too many files in batch, max is " + str(max_batch_files))
+    else:
+      files = [body]
+
+    for file in files:
+      if "filename" not in file:
+        raise Exception("event has a body but no filename")
+      if "data" not in file and not presigned:
+        raise Exception("event has a body but no data")
+
+      print("filename:", file["filename"])
+
+      if not presigned:
+        print("datastr (first 10 chars):", file["data"][0:10])
 
     #
     # open connection to the database:
@@ -157,117 +260,352 @@ def lambda_handler(event, context):
     #
     print("**Checking if userid is valid**")
     
-    sql = "SELECT * FROM users WHERE userid = %s;"
-    
-    row = datatier.retrieve_one_row(dbConn, sql, [userid])
+    username = lookup_username(dbConn, userid, configur.getint('users', 'cache_ttl_secs', fallback=300))
     
-    if row == ():  # no such user
+    if username is None:  # no such user
       print("**No such user, returning...**")
       return {
         'statusCode': 400,
         'body': json.dumps("no such user...")
       }
     
-    print(row)
-    
-    username = row[1]
-    
+    print("username:", username)
+
     #
-    # at this point the user exists, so safe to upload to S3:
+    # which bucket, based on action:
     #
-    base64_bytes = datastr.encode()        # string -> base64 bytes
-    bytes = base64.b64decode(base64_bytes) # base64 bytes -> raw bytes
-    
+    if action == "typeid":
+      bucket = bucket_typeid
+      bucket_name = "bucket_typeid"
+    elif action == "typecov":
+      bucket = bucket_typecov
+      bucket_name = "bucket_typecov"
+    elif action == "formatcov":
+      bucket = bucket_formatcov
+      bucket_name = "bucket_formatcov"
+
     #
-    # write raw bytes to local filesystem for upload:
+    # decode each file's base64 data into an in-memory buffer
+    # and drop the string, so only one copy of the image is
+    # held, and hash the content of the image:
     #
-    print("**Writing local data file**")
+    datas = [None] * len(files)
+    contenthashes = [''] * len(files)
+
+    if not presigned:
+      print("**Decoding data**")
+
+      for (i, file) in enumerate(files):
+        datas[i] = bodydecoder.decode_base64(file["data"])
+
+        del file["data"]
+
+        with datas[i].getbuffer() as view:
+          print("data size:", view.nbytes)
+          contenthashes[i] = hashlib.sha256(view).hexdigest()
 
-    local_filename = "/tmp/data.jpg"
-    
-    outfile = open(local_filename, "wb")
-    outfile.write(bytes)
-    outfile.close()
-    
     #
-    # generate unique filename in preparation for the S3 upload:
+    # generate unique filenames in preparation for the S3 upload.
+    # The image format is sniffed from the data, whatever the
+    # extension of the filename; a presigned upload has no data
+    # yet, so there it comes from the extension:
     #
-    print("**Uploading local file to S3**")
-    
-    basename = pathlib.Path(filename).stem
-    extension = pathlib.Path(filename).suffix
-    
-    if extension != ".jpg" and extension != ".jpeg" : 
-      raise Exception("expecting filename to have .jpg extension")
+    accepted_formats = [f.strip() for f in configur.get('upload', 'formats', fallback='jpeg, png, webp').split(",")]
+
+    bucketkeys = []
+    image_formats = []
+
+    for (file, data) in zip(files, datas):
+      basename = pathlib.Path(file["filename"]).stem
+      extension = pathlib.Path(file["filename"]).suffix
+
+      if presigned:
+        image_format = imagecodec.format_for_extension(extension)
+      else:
+        image_format = imagecodec.sniff_format(data.getbuffer())
+
+      if image_format not in accepted_formats:
+        raise Exception("expecting " + file["filename"] + " to be an image in one of the formats: " + ", ".join(accepted_formats))
+        
+      bucketkey = username + "/" + basename + "-" + str(uuid.uuid4()) + imagecodec.formats[image_format][0]
       
-    bucketkey = username + "/" + basename + "-" + str(uuid.uuid4()) + ".jpg"
-    
-    print("S3 bucketkey:", bucketkey)
+      print("S3 bucketkey:", bucketkey)
+
+      bucketkeys.append(bucketkey)
+      image_formats.append(image_format)
+
+    #
+    # dedup: an image identical to one that already completed
+    # for the same action and target gets that job's results,
+    # without uploading it or running the compute lambda
+    # again. Fallback results aren't reused, and neither are
+    # multi-type typecov jobs, whose results are per type in
+    # jobtargets. Presigned uploads never pass through here,
+    # so they aren't hashed or deduped:
+    #
+    if action == "typecov":
+      target = target_type
+    else:
+      target = target_format
+
+    matches = {}
+
+    dedup = configur.getboolean('upload', 'dedup', fallback=True)
+
+    if dedup and not presigned and "," not in target and target != "all":
+      hashes = sorted(set(contenthashes))
+
+      sql = """
+        SELECT contenthash, COALESCE(dedupof, jobid), resultsfilekey, result FROM jobs
+         WHERE bucket = %s AND target = %s AND status = 'completed' AND fallback = 0
+           AND contenthash IN (""" + ", ".join(["%s"] * len(hashes)) + ");"
+
+      rows = datatier.retrieve_all_rows(dbConn, sql, [bucket_name, target] + hashes)
+
+      for (contenthash, dedupof, resultsfilekey, result) in rows:
+        matches.setdefault(contenthash, (dedupof, resultsfilekey, result))
+
+      print("dedup hits:", sum(1 for h in contenthashes if h in matches), "of", len(files))
+
+    #
+    # admission control: when the remote model behind typecov
+    # is backed up, reject new typecov jobs up front with an
+    # estimate of the wait, instead of letting them time out.
+    # The backlog counts remote calls, i.e. each pending job
+    # weighs its number of types. Jobs that haven't changed in
+    # stale_secs are left out: their lambda crashed or timed
+    # out, and they would otherwise block admissions forever.
+    # Dedup hits make no remote calls, so they don't count:
+    #
+    if action == "typecov":
+      max_backlog = configur.getint('admission', 'typecov_max_backlog', fallback=50)
+      secs_per_job = configur.getfloat('admission', 'typecov_secs_per_job', fallback=30)
+      concurrency = configur.getint('admission', 'typecov_concurrency', fallback=4)
+      stale_secs = configur.getint('admission', 'typecov_stale_secs', fallback=900)
+
+      sql = """
+        SELECT COALESCE(SUM(targetcount), 0) FROM jobs
+         WHERE bucket = 'bucket_typecov' AND status IN ('uploaded', 'processing')
+           AND updatedat >= NOW(6) - INTERVAL %s SECOND;
+      """
+
+      row = datatier.retrieve_one_row(dbConn, sql, [stale_secs])
+
+      backlog = int(row[0])
+      admitted = target_count * sum(1 for h in contenthashes if h not in matches)
+
+      print("typecov backlog:", backlog, "remote calls, adding", admitted)
+
+      #
+      # a batch is admitted only if all of its jobs fit:
+      #
+      if admitted > 0 and backlog + admitted > max_backlog:
+        estimated_wait = int((backlog + admitted - max_backlog) * secs_per_job / concurrency)
+
+        print("**typecov backlog is full, returning...**")
+        return {
+          'statusCode': 429,
+          'headers': {
+            'Retry-After': str(estimated_wait)
+          },
+          'body': json.dumps({
+            'text': 'typecov is busy, try again later',
+            'backlog': backlog,
+            'estimated_wait': estimated_wait
+          })
+        }
 
     #
     # Remember that the processing of the PNG is event-triggered,
     # and that lambda function is going to update the database as
-    # is processes. So let's insert a job record into the database
-    # first, THEN upload the PDF to S3. The status column should 
-    # be set to 'uploaded':
+    # is processes. So let's insert the job records into the
+    # database first, THEN upload the PDFs to S3. The status
+    # column should be set to 'uploaded', or 'completed' for a
+    # dedup hit. All the rows go in with one multi-row insert:
     #
-    print("**Adding jobs row to database**")
-    
-    sql = """
-      INSERT INTO jobs(userid, status, originaldatafile, datafilekey, resultsfilekey, bucket)
-                  VALUES(%s, %s, %s, %s, '', %s);
-    """
-    
-    if action == "typeid":
-      bucket = bucket_typeid
-      bucket_name = "bucket_typeid"
-    elif action == "typecov":
-      bucket = bucket_typecov
-      bucket_name = "bucket_typecov"
-    elif action == "formatcov":
-      bucket = bucket_formatcov
-      bucket_name = "bucket_formatcov"
+    print("**Adding jobs rows to database**")
 
-    datatier.perform_action(dbConn, sql, [userid, 'uploaded', filename, bucketkey, bucket_name])
+    sql = "INSERT INTO jobs(userid, status, originaldatafile, datafilekey, resultsfilekey, bucket, contenthash, target, dedupof, result, targetcount) VALUES "
+    sql += ", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"] * len(files)) + ";"
+
+    parameters = []
+    for (file, bucketkey, contenthash) in zip(files, bucketkeys, contenthashes):
+      if contenthash in matches:
+        (dedupof, resultsfilekey, result) = matches[contenthash]
+        parameters.extend([userid, 'completed', file["filename"], bucketkey, resultsfilekey, bucket_name, contenthash, target, dedupof, result, target_count])
+      else:
+        parameters.extend([userid, 'uploaded', file["filename"], bucketkey, '', bucket_name, contenthash, target, None, None, target_count])
+
+    try:
+      datatier.perform_action(dbConn, sql, parameters)
+    except Exception as err:
+      #
+      # the user was cached but has since been deleted, so the
+      # foreign key on userid rejected the rows (MySQL error
+      # 1452):
+      #
+      if len(err.args) > 0 and err.args[0] == 1452:
+        forget_username(userid)
+        print("**No such user, returning...**")
+        return {
+          'statusCode': 400,
+          'body': json.dumps("no such user...")
+        }
+      raise
 
     #
-    # grab the jobid that was auto-generated by mysql:
+    # grab the jobids that were auto-generated by mysql. The
+    # ids of a multi-row insert aren't guaranteed consecutive,
+    # so look them up by their (unique) bucketkeys:
     #
-    sql = "SELECT LAST_INSERT_ID();"
+    sql = "SELECT jobid, datafilekey FROM jobs WHERE datafilekey IN ("
+    sql += ", ".join(["%s"] * len(bucketkeys)) + ");"
     
-    row = datatier.retrieve_one_row(dbConn, sql)
+    rows = datatier.retrieve_all_rows(dbConn, sql, bucketkeys)
     
-    jobid = row[0]
+    jobids_by_key = {datafilekey: jobid for (jobid, datafilekey) in rows}
+
+    jobids = [jobids_by_key[bucketkey] for bucketkey in bucketkeys]
     
-    print("jobid:", jobid)
+    print("jobids:", jobids)
+
+    s3_client = boto3.client('s3')
 
     #
-    # now that DB is updated, let's upload PNG to S3:
+    # presigned upload: the lambda never touches the images.
+    # The client POSTs each one straight to the bucket, and the
+    # policy pins the key, ACL, content type and the metadata
+    # the compute lambdas read, so the client can't change them:
     #
-    print("**Uploading data file to S3**")
+    if presigned:
+      expires_secs = configur.getint('upload', 'presigned_expires_secs', fallback=900)
+      max_upload_bytes = configur.getint('upload', 'max_upload_bytes', fallback=20 * 1024 * 1024)
 
-  
-    bucket.upload_file(local_filename,
-                      bucketkey, 
-                      ExtraArgs={
-                        'ACL': 'public-read',
-                        'ContentType': 'image/jpeg',
-                        'Metadata': {
-                          'target-type': target_type,
-                          'target-format': target_format
-                        }
-                      })
-                      
+      uploads = []
+
+      for (jobid, bucketkey, image_format) in zip(jobids, bucketkeys, image_formats):
+        fields = {
+          'acl': 'public-read',
+          'Content-Type': imagecodec.formats[image_format][1],
+          'x-amz-meta-target-type': target_type,
+          'x-amz-meta-target-format': target_format
+        }
+
+        conditions = [{k: v} for (k, v) in fields.items()]
+        conditions.append(['content-length-range', 1, max_upload_bytes])
+
+        post = s3_client.generate_presigned_post(bucket.name,
+                                                 bucketkey,
+                                                 Fields=fields,
+                                                 Conditions=conditions,
+                                                 ExpiresIn=expires_secs)
+
+        uploads.append({
+          'jobid': str(jobid),
+          'url': post['url'],
+          'fields': post['fields'],
+          'expires_in': expires_secs
+        })
+
+      print("**DONE, returning jobids and presigned POSTs**")
+
+      return {
+        'statusCode': 200,
+        'body': json.dumps(uploads if batch else uploads[0])
+      }
+
+    #
+    # at this point the user exists, so safe to upload to S3.
+    # The files of a batch upload concurrently; deduped files
+    # are already completed and aren't uploaded:
+    #
+    print("**Uploading data files to S3**")
+
+    multipart_chunksize = configur.getint('upload', 'multipart_chunksize', fallback=8 * 1024 * 1024)
+    batch_concurrency = configur.getint('upload', 'batch_concurrency', fallback=8)
+
+    transfer_config = TransferConfig(multipart_threshold=multipart_chunksize,
+                                     multipart_chunksize=multipart_chunksize,
+                                     max_concurrency=4)
+
+    #
+    # optionally normalize each image first (orientation,
+    # metadata, size), so the compute lambda gets no bigger an
+    # image than its action needs:
+    #
+    normalize = configur.getboolean('normalize', 'enabled', fallback=False)
+
+    if normalize:
+      import imagenormalize
+
+      max_px = configur.getint('normalize', action + '_max_px', fallback=0)
+      quality = configur.getint('normalize', 'quality', fallback=85)
+
+    def upload_file(data, bucketkey, image_format):
+      if normalize:
+        data = imagenormalize.normalize(data, image_format, max_px, quality)
+
+      s3_client.upload_fileobj(data,
+                               bucket.name,
+                               bucketkey,
+                               Config=transfer_config,
+                               ExtraArgs={
+                                 'ACL': 'public-read',
+                                 'ContentType': imagecodec.formats[image_format][1],
+                                 'Metadata': {
+                                   'target-type': target_type,
+                                   'target-format': target_format
+                                 }
+                               })
+
+    failed = []
+    errors = []
+
+    uploads = [(jobid, data, bucketkey, image_format)
+               for (jobid, data, bucketkey, image_format, contenthash) in zip(jobids, datas, bucketkeys, image_formats, contenthashes)
+               if contenthash not in matches]
+
+    with ThreadPoolExecutor(max_workers=max(1, min(batch_concurrency, len(uploads)))) as executor:
+      futures = [(jobid, executor.submit(upload_file, data, bucketkey, image_format))
+                 for (jobid, data, bucketkey, image_format) in uploads]
 
+      for (jobid, future) in futures:
+        try:
+          future.result()
+        except Exception as err:
+          print("**Upload of job", jobid, "failed:", str(err))
+          failed.append(jobid)
+          errors.append(err)
+
+    #
+    # a job whose image never reached S3 will never be
+    # processed, so mark it as an error. A batch still
+    # returns all its jobids, the failed ones show up as
+    # errors on download:
+    #
+    if len(failed) > 0:
+      sql = "UPDATE jobs SET status = 'error' WHERE jobid IN ("
+      sql += ", ".join(["%s"] * len(failed)) + ");"
+
+      datatier.perform_action(dbConn, sql, failed)
+
+      if not batch:
+        raise errors[0]
+                      
     #
     # respond in an HTTP-like way, i.e. with a status
     # code and body in JSON format:
     #
-    print("**DONE, returning jobid**")
+    print("**DONE, returning jobids**")
     
+    if batch:
+      body = [str(jobid) for jobid in jobids]
+    else:
+      body = str(jobids[0])
+
     return {
       'statusCode': 200,
-      'body': json.dumps(str(jobid))
+      'body': json.dumps(body)
     }
     
   except Exception as err:
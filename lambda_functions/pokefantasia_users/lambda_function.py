@@ -1,15 +1,84 @@
 #
-# Retrieves and returns all the users in the 
-# Pokefantasia database.
+# Retrieves and returns the users in the Pokefantasia
+# database, a page at a time in userid order, with only their
+# public columns (never the password hash). Each page ends with
+# the cursor of the next page (the last userid returned, or
+# None after the last page).
+#
+# With export=ndjson or export=gzip, exports the users (without
+# their password hashes) to an S3 object instead, and returns a
+# presigned link to it (see rowexport).
 #
 
 import json
 import boto3
 import os
+import uuid
 import datatier
+import rowexport
 
 from configparser import ConfigParser
 
+
+#
+# the public columns of a user, the only ones returned
+#
+columns = ["userid", "username"]
+
+
+def get_parameter(event, name, default):
+  """
+  Returns the named parameter from the event, the URL path
+  ("pathParameters") or the query string, or default if absent
+  """
+  if name in event:
+    return event[name]
+  for params in ("pathParameters", "queryStringParameters"):
+    if event.get(params) and name in event[params]:
+      return event[params][name]
+  return default
+
+
+def export_users(configur, dbConn, export):
+  """
+  Exports the users, in userid order and without their password
+  hashes, to an NDJSON object (gzipped if export is "gzip") in
+  the S3 bucket, reading them through an unbuffered cursor.
+
+  Returns
+  -------
+  dict with a presigned url to the export, its key, the number
+  of rows, and the lifetime of the url
+  """
+  boto3.setup_default_session(profile_name='s3readwrite')
+  s3_client = boto3.client('s3')
+
+  bucket = configur.get('s3', 'bucket_name')
+  key = "exports/users-" + str(uuid.uuid4()) + (".ndjson.gz" if export == "gzip" else ".ndjson")
+
+  expires_secs = configur.getint('export', 'presigned_expires_secs', fallback=3600)
+  part_size = configur.getint('export', 'part_size', fallback=8 * 1024 * 1024)
+
+  sql = "SELECT " + ", ".join(columns) + " FROM users ORDER BY userid;"
+
+  print("**Exporting to", key, "**")
+
+  count = rowexport.export_rows(s3_client, bucket, key, columns,
+                                datatier.stream_rows(dbConn, sql),
+                                export == "gzip", part_size)
+
+  url = s3_client.generate_presigned_url('get_object',
+                                         Params={'Bucket': bucket, 'Key': key},
+                                         ExpiresIn=expires_secs)
+
+  return {
+    'url': url,
+    'key': key,
+    'rows': count,
+    'expires_in': expires_secs
+  }
+
+
 def lambda_handler(event, context):
   try:
     print("**STARTING**")
@@ -33,6 +102,26 @@ def lambda_handler(event, context):
     rds_pwd = configur.get('rds', 'user_pwd')
     rds_dbname = configur.get('rds', 'db_name')
 
+    #
+    # the page: users after the cursor (a userid, 0 for the
+    # first page), at most limit of them. Or with export, all
+    # of them to S3:
+    #
+    default_limit = configur.getint('users', 'default_limit', fallback=100)
+    max_limit = configur.getint('users', 'max_limit', fallback=1000)
+
+    cursor = int(get_parameter(event, "cursor", 0))
+    limit = int(get_parameter(event, "limit", default_limit))
+    export = get_parameter(event, "export", None)
+
+    if export not in (None, "ndjson", "gzip"):
+      raise Exception("export must be ndjson or gzip")
+
+    if limit < 1 or limit > max_limit:
+      raise Exception("limit must be between 1 and " + str(max_limit))
+
+    print("cursor:", cursor, "limit:", limit, "export:", export)
+
     #
     # open connection to the database:
     #
@@ -40,15 +129,33 @@ def lambda_handler(event, context):
     
     dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
     
+    if export is not None:
+      body = export_users(configur, dbConn, export)
+
+      print("**DONE, exported", body['rows'], "users**")
+
+      return {
+        'statusCode': 200,
+        'body': json.dumps(body)
+      }
+
     #
-    # now retrieve all the users:
+    # now retrieve the page of users, plus one more to know if
+    # there's a next page:
     #
     print("**Retrieving data**")
-    sql = "SELECT * FROM users ORDER BY userid;";
-    rows = datatier.retrieve_all_rows(dbConn, sql)
+    sql = "SELECT " + ", ".join(columns) + " FROM users WHERE userid > %s ORDER BY userid LIMIT %s;"
+    rows = datatier.retrieve_all_rows(dbConn, sql, [cursor, limit + 1])
     
-    for row in rows:
-      print(row)
+    print(len(rows), "rows")
+
+    next_cursor = None
+
+    if len(rows) > limit:
+      rows = rows[0:limit]
+      next_cursor = rows[-1][0]
+
+    users = [dict(zip(columns, row)) for row in rows]
 
     #
     # respond in an HTTP-like way, i.e. with a status
@@ -58,7 +165,10 @@ def lambda_handler(event, context):
     
     return {
       'statusCode': 200,
-      'body': json.dumps(rows)
+      'body': json.dumps({
+        'users': users,
+        'next_cursor': next_cursor
+      })
     }
     
   except Exception as err:
@@ -0,0 +1,95 @@
+#
+# rowexport.py
+#
+# Exports rows from the database to an S3 object as NDJSON (one
+# JSON object per line), optionally gzip-compressed, for admin
+# exports of whole tables. Rows are streamed: they're read one
+# at a time (see datatier.stream_rows), encoded, and sent to S3
+# a part at a time in a multipart upload, so memory is bounded
+# by the part size however many rows there are.
+#
+# The same module is used by the jobs and users lambdas.
+#
+
+import json
+import zlib
+
+
+###################################################################
+#
+# export_rows:
+#
+# An export smaller than one part is sent with a single PUT
+# instead of a multipart upload. If anything fails, the
+# multipart upload is aborted so no parts are left behind.
+#
+def export_rows(s3_client, bucket, key, columns, rows, compress=False, part_size=8 * 1024 * 1024):
+  """
+  Writes rows to an S3 object as NDJSON
+
+  Parameters
+  ----------
+  s3_client : S3 client,
+  bucket : name of the bucket,
+  key : key of the object to write,
+  columns : names of the columns of the rows,
+  rows : iterable of rows (tuples),
+  compress : True to gzip the NDJSON,
+  part_size : bytes per part of the upload (at least 5 MB)
+
+  Returns
+  -------
+  number of rows exported
+  """
+  if compress:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31: gzip format
+    content_type = "application/gzip"
+  else:
+    compressor = None
+    content_type = "application/x-ndjson"
+
+  buffer = bytearray()
+  parts = []
+  upload_id = None
+  count = 0
+
+  def send_part(data):
+    nonlocal upload_id
+
+    if upload_id is None:
+      upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=key, ContentType=content_type)['UploadId']
+
+    response = s3_client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id,
+                                     PartNumber=len(parts) + 1, Body=bytes(data))
+
+    parts.append({'PartNumber': len(parts) + 1, 'ETag': response['ETag']})
+
+  try:
+    for row in rows:
+      line = (json.dumps(dict(zip(columns, row)), default=str) + "\n").encode()
+
+      buffer += compressor.compress(line) if compressor is not None else line
+      count += 1
+
+      if len(buffer) >= part_size:
+        send_part(buffer)
+        buffer = bytearray()
+
+    if compressor is not None:
+      buffer += compressor.flush()
+
+    if upload_id is None:
+      s3_client.put_object(Bucket=bucket, Key=key, Body=bytes(buffer), ContentType=content_type)
+    else:
+      if len(buffer) > 0:
+        send_part(buffer)
+
+      s3_client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                          MultipartUpload={'Parts': parts})
+
+    return count
+
+  except Exception:
+    if upload_id is not None:
+      s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+    raise
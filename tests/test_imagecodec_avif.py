@@ -0,0 +1,55 @@
+#
+# test_imagecodec_avif.py
+#
+# Checks that imagecodec decodes a real AVIF file the way the
+# compute lambdas use it. AVIF uploads should only be accepted
+# (see formats in the upload config) where this passes for the
+# typecov and formatcov lambdas, i.e. with Pillow 11.3+ or
+# pillow-avif-plugin in their layers.
+#
+# Usage: python -m pytest tests
+#
+
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda_functions", "pokefantasia_compute_typecov"))
+
+import imagecodec
+
+
+@unittest.skipUnless(imagecodec.avif_supported(), "no AVIF decoder installed")
+class AvifDecodeTest(unittest.TestCase):
+
+  def setUp(self):
+    from PIL import Image
+
+    image = Image.new("RGB", (64, 48), (200, 40, 20))
+
+    data = io.BytesIO()
+    image.save(data, format="AVIF", quality=90)
+    self.data = data.getvalue()
+
+  def test_sniffs_avif(self):
+    self.assertEqual(imagecodec.sniff_format(self.data), "avif")
+
+  def test_decodes_to_bgr(self):
+    image = imagecodec.decode_bgr(self.data)
+
+    self.assertEqual(image.shape, (48, 64, 3))
+
+    (blue, green, red) = image[24, 32]
+    self.assertLess(abs(int(red) - 200), 12)
+    self.assertLess(abs(int(green) - 40), 12)
+    self.assertLess(abs(int(blue) - 20), 12)
+
+  def test_decodes_reduced(self):
+    image = imagecodec.decode_bgr(self.data, reduce=2)
+
+    self.assertEqual(image.shape, (24, 32, 3))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,95 @@
+#
+# test_typecov_fallback.py
+#
+# Checks that pokefantasia_compute_typecov degrades to the local
+# recolor renderer when the remote model is reachable but every
+# call to it fails, instead of failing the job.
+#
+# Usage: python -m pytest tests
+#
+
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import cv2
+import numpy as np
+
+from configparser import ConfigParser
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda_functions", "pokefantasia_compute_typecov"))
+
+import lambda_function as typecov
+
+
+class RenderTypeFallbackTest(unittest.TestCase):
+
+  def setUp(self):
+    tmpdir = tempfile.TemporaryDirectory()
+    self.addCleanup(tmpdir.cleanup)
+
+    self.local_file = os.path.join(tmpdir.name, "pokemon.png")
+    cv2.imwrite(self.local_file, np.full((64, 64, 3), 128, dtype=np.uint8))
+
+    #
+    # the circuit breaker stays closed and there are always
+    # tokens, so only the remote calls themselves fail:
+    #
+    for name in ("allow_request", "record_failure", "record_success"):
+      patcher = mock.patch.object(typecov.circuitbreaker, name, return_value=True)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+    self.rate_limiter = mock.Mock()
+    self.rate_limiter.acquire.return_value = True
+
+    self.configur = ConfigParser()
+    self.configur.read_dict({
+      'typecov': {
+        'remote_timeout_secs': '5',
+        'max_retries': '2',
+        'backoff_base_secs': '0',
+        'backoff_max_secs': '0'
+      }
+    })
+
+    self.client = mock.Mock()
+    self.client.submit.side_effect = ConnectionError("remote model went away")
+
+    self.output_bucket = mock.Mock()
+
+  def remote_job(self):
+    settings = typecov.RemoteSettings(self.configur)
+    output = typecov.OutputSettings(self.configur)
+
+    return typecov.RemoteJob(settings, output, None, threading.Lock(), self.rate_limiter,
+                             time.time() + 60, typecov.jobtiming.StageTimer())
+
+  def test_falls_back_when_retries_run_out(self):
+    fallback = typecov.render_type(self.client, self.output_bucket, self.local_file, "fire",
+                                   "ash/pokemon-fire.jpg", self.remote_job())
+
+    self.assertTrue(fallback)
+    self.assertEqual(self.client.submit.call_count, 3)  # first call and 2 retries
+
+    self.output_bucket.put_object.assert_called_once()
+    kwargs = self.output_bucket.put_object.call_args.kwargs
+    self.assertEqual(kwargs['Key'], "ash/pokemon-fire.jpg")
+    self.assertEqual(kwargs['Metadata'], {'fallback': 'true'})
+
+  def test_fails_when_fallback_disabled(self):
+    self.configur.set('typecov', 'fallback', 'false')
+
+    with self.assertRaises(ConnectionError):
+      typecov.render_type(self.client, self.output_bucket, self.local_file, "fire",
+                          "ash/pokemon-fire.jpg", self.remote_job())
+
+    self.output_bucket.put_object.assert_not_called()
+
+
+if __name__ == "__main__":
+  unittest.main()